@@ -12,16 +12,20 @@ from monkeytype.config import (
     Config,
     get_default_config,
 )
-from monkeytype.tracing import trace_calls
+from monkeytype.tracing import CallTracer, trace_calls
 
 __version__ = "21.5.1.dev1"
 
 
-def trace(config: Optional[Config] = None) -> ContextManager:
+def trace(config: Optional[Config] = None, attribute_costs: bool = False) -> ContextManager[CallTracer]:
     """Context manager to trace and log all calls.
 
     Simple wrapper around `monkeytype.tracing.trace_calls` that uses trace
-    logger, code filter, and sample rate from given (or default) config.
+    logger, code filter, and sample rate from given (or default) config. The
+    config's type handlers are registered in `monkeytype.typing.TYPE_HANDLERS`
+    until the block exits.
+    With `attribute_costs`, the tracer adds up the cost of tracing each
+    function (see `CallTracer.top_costs`).
     """
     if config is None:
         config = get_default_config()
@@ -30,4 +34,16 @@ def trace(config: Optional[Config] = None) -> ContextManager:
         code_filter=config.code_filter(),
         sample_rate=config.sample_rate(),
         max_typed_dict_size=config.max_typed_dict_size(),
+        signature_cache_size=config.signature_cache_size(),
+        all_threads=config.trace_all_threads(),
+        type_budget=config.type_budget(),
+        immutable_type_cache_size=config.immutable_type_cache_size(),
+        deep_sample_rate=config.deep_sample_rate(),
+        yield_sample_threshold=config.yield_sample_threshold(),
+        sampling_policy=config.sampling_policy(),
+        convergence=config.convergence(),
+        cpu_budget=config.cpu_budget(),
+        metrics_reporter=config.metrics_reporter(),
+        attribute_costs=attribute_costs,
+        type_handlers=config.type_handlers(),
     )
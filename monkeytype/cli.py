@@ -33,9 +33,9 @@ from monkeytype.stubs import (
     Stub,
     build_module_stubs_from_traces,
 )
-from monkeytype.tracing import CallTrace
+from monkeytype.tracing import CallTrace, CallTracer
 from monkeytype.typing import NoOpRewriter
-from monkeytype.util import get_name_in_module
+from monkeytype.util import get_func_fqname, get_name_in_module
 
 
 if TYPE_CHECKING:
@@ -212,11 +212,23 @@ def list_modules_handler(args: argparse.Namespace, stdout: IO, stderr: IO) -> No
     print(output, file=file)
 
 
+def display_tracing_costs(tracer: CallTracer, limit: int, stderr: IO) -> None:
+    """Print to stderr the functions that were the most expensive to trace."""
+    print(f"{'total ms':>10} {'get_type ms':>12} {'calls':>8}  function", file=stderr)
+    for code, cost in tracer.top_costs(limit):
+        func = tracer.cache.get(code)
+        if func is not None:
+            name = get_func_fqname(func)
+        else:
+            name = f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})'
+        print(f"{cost.handler_ns / 1e6:>10.3f} {cost.get_type_ns / 1e6:>12.3f} {cost.calls:>8}  {name}", file=stderr)
+
+
 def run_handler(args: argparse.Namespace, stdout: IO, stderr: IO) -> None:
     # remove initial `monkeytype run`
     old_argv = sys.argv.copy()
     try:
-        with trace(args.config):
+        with trace(args.config, attribute_costs=bool(args.tracing_costs)) as tracer:
             sys.argv = [args.script_path] + args.script_args
             if args.m:
                 runpy.run_module(args.script_path, run_name='__main__', alter_sys=True)
@@ -224,6 +236,8 @@ def run_handler(args: argparse.Namespace, stdout: IO, stderr: IO) -> None:
                 runpy.run_path(args.script_path, run_name='__main__')
     finally:
         sys.argv = old_argv
+    if args.tracing_costs:
+        display_tracing_costs(tracer, args.tracing_costs, stderr)
 
 
 def update_args_from_config(args: argparse.Namespace) -> None:
@@ -280,6 +294,13 @@ def main(argv: List[str], stdout: IO, stderr: IO) -> int:
         action='store_true',
         help="Run a library module as a script"
     )
+    run_parser.add_argument(
+        '--tracing-costs',
+        type=int,
+        metavar='N',
+        default=0,
+        help="Print to stderr the N functions that were the most expensive to trace",
+    )
     run_parser.add_argument(
         'script_args',
         nargs=argparse.REMAINDER,
@@ -62,6 +62,9 @@ def __are_typed_dict_types_equal(type1: type, type2: type) -> bool:
     Doing this explicitly because
     TypedDict('Foo', {'a': int}) != TypedDict('Foo', {'a': int})."""
 
+    # Anonymous TypedDicts of the same shape are interned by make_typed_dict
+    if type1 is type2:
+        return True
     if not is_typed_dict(type2):
         return False
     total1 = getattr(type1, "__total__", True)
@@ -4,9 +4,10 @@
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree.
 from contextlib import contextmanager
-import functools
+import fnmatch
 import os
 import pathlib
+import re
 import sys
 import sysconfig
 
@@ -15,7 +16,17 @@ from abc import (
     abstractmethod,
 )
 from types import CodeType
-from typing import Optional, Iterator
+from typing import (
+    Any,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    Mapping,
+    Optional,
+    Pattern,
+    Tuple,
+)
 
 from monkeytype.db.base import (
     CallTraceStore,
@@ -25,10 +36,15 @@ from monkeytype.db.sqlite import SQLiteStore
 from monkeytype.tracing import (
     CallTraceLogger,
     CodeFilter,
+    Convergence,
+    MetricsReporter,
+    SamplingPolicy,
 )
 from monkeytype.typing import (
     DEFAULT_REWRITER,
     NoOpRewriter,
+    TypeBudget,
+    TypeHandler,
     TypeRewriter,
 )
 
@@ -77,6 +93,99 @@ class Config(metaclass=ABCMeta):
         """
         return None
 
+    def sampling_policy(self) -> Optional[SamplingPolicy]:
+        """Return the policy deciding which calls to trace.
+
+        By default (None), calls are traced according to sample_rate. See
+        monkeytype.tracing.AdaptiveSamplingPolicy for a policy that traces
+        rare functions every time and hot ones less and less often.
+        """
+        return None
+
+    def convergence(self) -> Optional[Convergence]:
+        """Return when to stop tracing functions whose types have settled.
+
+        By default (None), functions are traced for as long as tracing runs.
+        """
+        return None
+
+    def cpu_budget(self) -> Optional[float]:
+        """Return the largest fraction of the process's CPU time to spend tracing.
+
+        If set (for example, to 0.02 for 2%), tracing is throttled and paused
+        as needed to stay within the budget; see
+        monkeytype.tracing.OverheadGovernor. By default (None), tracing is
+        never throttled.
+        """
+        return None
+
+    def metrics_reporter(self) -> Optional[MetricsReporter]:
+        """Return a reporter to push the tracer's metrics to a callback periodically.
+
+        By default (None), metrics are only available from CallTracer.metrics().
+        """
+        return None
+
+    def deep_sample_rate(self) -> Optional[int]:
+        """Return the sample rate for typing traced values in full.
+
+        By default, all traced calls get full types. If an integer rate of N is
+        set, 1/N traced calls will; the rest only record the shallow type of
+        each value, with builtin containers typed as C[Any].
+        """
+        return None
+
+    def yield_sample_threshold(self) -> Optional[int]:
+        """Return how many yielded values of each traced call to type before sampling.
+
+        By default, every yielded value is typed. If an integer threshold of N
+        is set, a call's first N yielded values are typed, and after that only
+        those whose position is a power of two.
+        """
+        return None
+
+    def signature_cache_size(self) -> Optional[int]:
+        """Return how many distinct signatures to remember per traced function.
+
+        Calls whose argument, return, and yield types match a remembered
+        signature are counted instead of being logged as new traces. By
+        default (None), every traced call is logged.
+        """
+        return None
+
+    def trace_all_threads(self) -> bool:
+        """Return whether to trace calls on all threads.
+
+        By default, only calls on the thread that starts tracing are traced.
+        """
+        return False
+
+    def type_budget(self) -> Optional[TypeBudget]:
+        """Return the (optional) TypeBudget bounding how much of each traced
+        value is inspected to infer its type.
+
+        By default (None), every element of every container is inspected,
+        however large or deeply nested.
+        """
+        return None
+
+    def immutable_type_cache_size(self) -> Optional[int]:
+        """Return how many deeply immutable tuples to remember the types of.
+
+        Functions called repeatedly with the same tuple constants then skip
+        walking them. By default (None), no types are remembered.
+        """
+        return None
+
+    def type_handlers(self) -> Mapping[type, TypeHandler]:
+        """Return functions to type values of particular classes or ABCs with.
+
+        Each handler is called with the value and max_typed_dict_size and
+        returns the value's static type; see monkeytype.typing.TypeHandlers.
+        The handlers are registered in TYPE_HANDLERS while tracing.
+        """
+        return {}
+
     def type_rewriter(self) -> TypeRewriter:
         """Return the type rewriter for use when generating stubs."""
         return NoOpRewriter()
@@ -100,35 +209,154 @@ if venv_real_prefix:
 LIB_PATHS = tuple(pathlib.Path(p).resolve() for p in lib_paths if p is not None)
 
 
-def _startswith(a: pathlib.Path, b: pathlib.Path) -> bool:
-    try:
-        return bool(a.relative_to(b))
-    except ValueError:
-        return False
+_TRIE_END = ''
+_GLOB_CHARS = frozenset('*?[')
 
 
-@functools.lru_cache(maxsize=8192)
-def default_code_filter(code: CodeType) -> bool:
-    """A CodeFilter to exclude stdlib and site-packages."""
-    # Filter code without a source file
-    if not code.co_filename or code.co_filename[0] == '<':
-        return False
+class PathTrie:
+    """A trie of filesystem paths, keyed by path component.
+
+    Finding which of many library paths contains a file costs one dict lookup
+    per component of the file's path, however many library paths there are.
+    """
+
+    def __init__(self, paths: Iterable[pathlib.Path]) -> None:
+        self.root: Dict[str, Any] = {}
+        for path in paths:
+            node = self.root
+            for part in path.parts:
+                node = node.setdefault(part, {})
+            node[_TRIE_END] = True
 
-    filename = pathlib.Path(code.co_filename).resolve()
-    # if MONKEYTYPE_TRACE_MODULES is defined, trace only specified packages or modules
-    trace_modules_str = os.environ.get('MONKEYTYPE_TRACE_MODULES')
-    if trace_modules_str is not None:
-        trace_modules = trace_modules_str.split(',')
-        # try to remove lib_path to only check package and module names
-        for lib_path in LIB_PATHS:
-            try:
-                filename = filename.relative_to(lib_path)
+    def longest_prefix(self, path: pathlib.Path) -> int:
+        """Return the number of components of the longest stored path that
+        contains `path`, or -1 if none does."""
+        longest = -1
+        node = self.root
+        for depth, part in enumerate(path.parts):
+            child = node.get(part)
+            if child is None:
                 break
-            except ValueError:
-                pass
-        return any(m == filename.stem or m in filename.parts for m in trace_modules)
-    else:
-        return not any(_startswith(filename, lib_path) for lib_path in LIB_PATHS)
+            node = child
+            if _TRIE_END in node:
+                longest = depth + 1
+        return longest
+
+
+class ModuleCodeFilter:
+    """A CodeFilter that selects code by the module it belongs to.
+
+    `include` and `exclude` are module names or globs. A plain name matches a
+    source file if it is any component of the file's path, without extension
+    (so 'foo' matches 'foo.py', 'foo/bar.py' and 'pkg/foo.py'); for files in
+    the stdlib and site-packages, only the path within the library counts. A
+    glob (e.g. 'foo.*') must match the whole dotted module name, relative to
+    the sys.path entry it's under. Exclusions win over inclusions. If `include` is None, all code
+    outside the stdlib and site-packages that isn't excluded is traced.
+
+    The patterns are compiled once, and each source file is only examined the
+    first time one of its code objects is seen; after that, a decision is a
+    single dict lookup.
+    """
+
+    def __init__(
+        self,
+        include: Optional[Iterable[str]] = None,
+        exclude: Iterable[str] = (),
+        lib_paths: Optional[Iterable[pathlib.Path]] = None,
+    ) -> None:
+        self.include = None if include is None else self._compile(include)
+        self.exclude = self._compile(exclude)
+        self.lib_paths = PathTrie(LIB_PATHS if lib_paths is None else lib_paths)
+        self.sys_path: Tuple[Tuple[str, ...], PathTrie] = ((), PathTrie(()))
+        self.decisions: Dict[str, bool] = {}
+
+    @classmethod
+    def from_environment(cls) -> 'ModuleCodeFilter':
+        """Build a filter that, if MONKEYTYPE_TRACE_MODULES is set, traces only
+        the comma-separated packages and modules it lists."""
+        trace_modules = os.environ.get('MONKEYTYPE_TRACE_MODULES')
+        return cls(include=None if trace_modules is None else trace_modules.split(','))
+
+    @staticmethod
+    def _compile(patterns: Iterable[str]) -> Tuple[FrozenSet[str], Optional[Pattern[str]]]:
+        names = set()
+        globs = []
+        for pattern in patterns:
+            if _GLOB_CHARS.isdisjoint(pattern):
+                names.add(pattern)
+            else:
+                globs.append(fnmatch.translate(pattern))
+        return frozenset(names), re.compile('|'.join(globs)) if globs else None
+
+    @staticmethod
+    def _matches(
+        patterns: Tuple[FrozenSet[str], Optional[Pattern[str]]],
+        path_parts: Tuple[str, ...],
+        module_parts: Tuple[str, ...],
+    ) -> bool:
+        names, globs = patterns
+        if not names.isdisjoint(path_parts):
+            return True
+        return globs is not None and globs.match('.'.join(module_parts)) is not None
+
+    def module_parts(self, filename: pathlib.Path) -> Tuple[Tuple[str, ...], bool]:
+        """Return the components of the dotted module name for `filename`, and
+        whether it lives in the stdlib or site-packages."""
+        depth = self.lib_paths.longest_prefix(filename)
+        is_lib = depth >= 0
+        if not is_lib:
+            depth = max(self._sys_path_roots().longest_prefix(filename), 0)
+        parts = filename.parts[depth:]
+        if not parts:
+            return (), is_lib
+        return parts[:-1] + (filename.stem,), is_lib
+
+    def _sys_path_roots(self) -> PathTrie:
+        entries = tuple(sys.path)
+        if entries != self.sys_path[0]:
+            self.sys_path = (entries, PathTrie(pathlib.Path(p or '.').resolve() for p in entries))
+        return self.sys_path[1]
+
+    def decide(self, co_filename: str) -> bool:
+        # Filter code without a source file
+        if not co_filename or co_filename[0] == '<':
+            return False
+        filename = pathlib.Path(co_filename).resolve()
+        parts, is_lib = self.module_parts(filename)
+        # Plain names match any component of the path of code outside the
+        # stdlib and site-packages, not just those of its module name.
+        path_parts = parts if is_lib else filename.parts[:-1] + (filename.stem,)
+        if self._matches(self.exclude, path_parts, parts):
+            return False
+        if self.include is None:
+            return not is_lib
+        return self._matches(self.include, path_parts, parts)
+
+    def __call__(self, code: CodeType) -> bool:
+        try:
+            return self.decisions[code.co_filename]
+        except KeyError:
+            decision = self.decisions[code.co_filename] = self.decide(code.co_filename)
+            return decision
+
+
+# The filters for the values MONKEYTYPE_TRACE_MODULES has had
+_environment_code_filters: Dict[Optional[str], ModuleCodeFilter] = {}
+
+
+def _environment_code_filter() -> ModuleCodeFilter:
+    trace_modules = os.environ.get('MONKEYTYPE_TRACE_MODULES')
+    code_filter = _environment_code_filters.get(trace_modules)
+    if code_filter is None:
+        code_filter = _environment_code_filters[trace_modules] = ModuleCodeFilter.from_environment()
+    return code_filter
+
+
+def default_code_filter(code: CodeType) -> bool:
+    """A CodeFilter to exclude stdlib and site-packages, or to trace only the
+    modules listed in MONKEYTYPE_TRACE_MODULES if it is set."""
+    return _environment_code_filter()(code)
 
 
 class DefaultConfig(Config):
@@ -147,8 +375,13 @@ class DefaultConfig(Config):
         return SQLiteStore.make_store(db_path)
 
     def code_filter(self) -> CodeFilter:
-        """Default code filter excludes standard library & site-packages."""
-        return default_code_filter
+        """Default code filter excludes standard library & site-packages.
+
+        Returns the ModuleCodeFilter behind default_code_filter, so that
+        MONKEYTYPE_TRACE_MODULES is read once when tracing starts rather than
+        on every call.
+        """
+        return _environment_code_filter()
 
 
 def get_default_config() -> Config:
@@ -3,18 +3,37 @@
 #
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree.
+import atexit
+import copy
+import enum
+import logging
+import queue
+import sys
+import threading
+import time
+import weakref
 from abc import (
     ABCMeta,
     abstractmethod,
 )
+from collections import deque
 from typing import (
+    Any,
+    Deque,
+    Dict,
     Iterable,
     List,
     Optional,
 )
 
 
-from monkeytype.tracing import CallTrace, CallTraceLogger
+from monkeytype.tracing import (
+    UNTRACED_THREADS,
+    CallTrace,
+    CallTraceLogger,
+)
+
+logger = logging.getLogger(__name__)
 
 
 class CallTraceThunk(metaclass=ABCMeta):
@@ -64,16 +83,307 @@ class CallTraceStore(metaclass=ABCMeta):
         )
 
 
+class OverflowPolicy(enum.Enum):
+    """What a logger does with new traces when its buffer is full."""
+    # Wait for room in the buffer
+    BLOCK = 'block'
+    # Discard the oldest buffered traces to make room for the new ones
+    DROP_OLDEST = 'drop_oldest'
+    # Discard the new traces
+    DROP_NEWEST = 'drop_newest'
+
+
+# Live loggers that are closed, storing their traces, when the process exits.
+# A single exit hook serves all of them, since a logger is created for every
+# trace block.
+_loggers_to_close_at_exit: 'weakref.WeakSet[CallTraceLogger]' = weakref.WeakSet()
+
+
+def _close_loggers_at_exit() -> None:
+    for trace_logger in list(_loggers_to_close_at_exit):
+        try:
+            trace_logger.close()
+        except Exception:
+            logger.exception("Failed to close trace logger at exit")
+
+
+atexit.register(_close_loggers_at_exit)
+
+
 class CallTraceStoreLogger(CallTraceLogger):
-    """A CallTraceLogger that stores logged traces in a CallTraceStore."""
-    def __init__(self, store: CallTraceStore) -> None:
+    """A CallTraceLogger that stores logged traces in a CallTraceStore.
+
+    Traces are buffered in memory until `flush` is called. The buffer is also
+    flushed automatically once it holds `max_traces` traces, roughly
+    `max_bytes` bytes of traces, or traces older than `max_age` seconds, and
+    when the process exits.
+
+    If storing traces fails, they are kept for the next flush, and automatic
+    flushes are suspended for `retry_interval` seconds. `max_buffered` bounds
+    the buffer in that case; once it is full, `overflow_policy` decides which
+    traces are dropped, and `dropped_traces` counts them. `metrics` reports
+    these counters along with flush counts, latency and rows written.
+    """
+    def __init__(
+        self,
+        store: CallTraceStore,
+        max_traces: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        max_age: Optional[float] = None,
+        max_buffered: Optional[int] = None,
+        overflow_policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST,
+        retry_interval: float = 1.0,
+        flush_at_exit: bool = True,
+    ) -> None:
+        if overflow_policy is OverflowPolicy.BLOCK:
+            raise ValueError("CallTraceStoreLogger cannot block; use DROP_OLDEST or DROP_NEWEST")
+        self.store = store
+        self.traces: Deque[CallTrace] = deque()
+        self.max_traces = max_traces
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_buffered = max_buffered
+        self.overflow_policy = overflow_policy
+        self.retry_interval = retry_interval
+        self.retry_after: Optional[float] = None
+        self.buffered_bytes = 0
+        self.oldest_trace_time: Optional[float] = None
+        self.dropped_traces = 0
+        self.failed_flushes = 0
+        self.logged_traces = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.flush_seconds = 0.0
+        self.last_flush_seconds = 0.0
+        self._flushing = False
+        if flush_at_exit:
+            _loggers_to_close_at_exit.add(self)
+
+    @staticmethod
+    def estimate_size(trace: CallTrace) -> int:
+        """A cheap, approximate size in bytes of a buffered trace."""
+        return sys.getsizeof(trace) + sys.getsizeof(trace.arg_types)
+
+    def _buffer(self, trace: CallTrace) -> None:
+        if self.max_buffered is not None and len(self.traces) >= self.max_buffered:
+            self.dropped_traces += 1
+            if self.overflow_policy is OverflowPolicy.DROP_NEWEST:
+                return
+            self.buffered_bytes -= self.estimate_size(self.traces.popleft())
+        if not self.traces:
+            self.oldest_trace_time = time.monotonic()
+        self.traces.append(trace)
+        self.buffered_bytes += self.estimate_size(trace)
+
+    def _should_flush(self) -> bool:
+        return (
+            (self.max_traces is not None and len(self.traces) >= self.max_traces) or
+            (self.max_bytes is not None and self.buffered_bytes >= self.max_bytes) or
+            (self.max_age is not None and self.oldest_trace_time is not None and
+             time.monotonic() - self.oldest_trace_time >= self.max_age)
+        )
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            'logged': self.logged_traces,
+            'buffered': len(self.traces),
+            'buffered_bytes': self.buffered_bytes,
+            'dropped': self.dropped_traces,
+            'flushes': self.flushes,
+            'failed_flushes': self.failed_flushes,
+            'rows_written': self.rows_written,
+            'flush_seconds': self.flush_seconds,
+            'last_flush_seconds': self.last_flush_seconds,
+        }
+
+    def log(self, trace: CallTrace) -> None:
+        if trace.func.__module__ == '__main__':
+            return
+        self.logged_traces += 1
+        self._buffer(trace)
+        if (
+            not self._flushing and
+            self._should_flush() and
+            (self.retry_after is None or time.monotonic() >= self.retry_after)
+        ):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to store traces")
+
+    def close(self) -> None:
+        if self.traces:
+            self.flush()
+
+    def flush(self) -> None:
+        # Swap the buffer out first, since storing the traces may itself be
+        # traced and logged.
+        traces, self.traces = self.traces, deque()
+        self.buffered_bytes = 0
+        self.oldest_trace_time = None
+        # Store a snapshot of each trace, since a CallTracer with a signature
+        # cache may count more calls on the original while it's being stored
+        # (from another thread, with all_threads).
+        snapshot = [copy.copy(trace) for trace in traces]
+        self._flushing = True
+        start = time.perf_counter()
+        try:
+            self.store.add(snapshot)
+        except Exception:
+            self.failed_flushes += 1
+            self.retry_after = time.monotonic() + self.retry_interval
+            # Keep the traces for the next flush, ahead of any logged since.
+            newer, self.traces = self.traces, deque()
+            for trace in traces:
+                self._buffer(trace)
+            for trace in newer:
+                self._buffer(trace)
+            raise
+        finally:
+            self._flushing = False
+            self.last_flush_seconds = time.perf_counter() - start
+            self.flush_seconds += self.last_flush_seconds
+        self.flushes += 1
+        self.rows_written += len(traces)
+        self.retry_after = None
+        # The stored rows now account for the snapshotted calls; a CallTracer
+        # with a signature cache will log the trace again if more calls come
+        # in. Calls counted since the snapshot are buffered for the next flush.
+        for trace, stored in zip(traces, snapshot):
+            trace.count -= stored.count
+            if trace.count > 0:
+                self._buffer(trace)
+
+
+# Tells the writer thread to exit
+_STOP = object()
+
+
+class BackgroundCallTraceStoreLogger(CallTraceLogger):
+    """A CallTraceLogger that stores traces from a dedicated writer thread.
+
+    Logged traces are collected into batches of `batch_size`, and full batches
+    are handed to the writer thread through a queue holding at most
+    `max_queue_size` batches. The writer thread serializes and stores them, so
+    the application thread never waits on the store unless the queue is full
+    and `overflow_policy` is BLOCK. With DROP_OLDEST or DROP_NEWEST, the
+    traces in dropped batches are counted in `dropped_traces`.
+
+    The writer thread is started when the first batch is queued. `flush`
+    queues the current batch and waits until everything queued has been
+    stored. `close` flushes and stops the writer thread; it is called when a
+    tracing block ends and when the process exits. Logging after `close`
+    starts a new writer thread.
+
+    The store must be usable from the writer thread; SQLiteStore.make_store
+    opens its connection with that in mind. `metrics` reports the queue
+    depth, drops, failed writes, rows written and time spent writing.
+    """
+    def __init__(
+        self,
+        store: CallTraceStore,
+        batch_size: int = 1000,
+        max_queue_size: int = 16,
+        overflow_policy: OverflowPolicy = OverflowPolicy.BLOCK,
+    ) -> None:
         self.store = store
+        self.batch_size = batch_size
+        self.overflow_policy = overflow_policy
         self.traces: List[CallTrace] = []
+        self.queue: 'queue.Queue[Any]' = queue.Queue(maxsize=max_queue_size)
+        self.dropped_traces = 0
+        self.failed_writes = 0
+        self.logged_traces = 0
+        self.rows_written = 0
+        self.write_seconds = 0.0
+        # The running writer thread holds a reference to the logger, so it is
+        # only started when needed and stopped by close.
+        self.writer: Optional[threading.Thread] = None
+        _loggers_to_close_at_exit.add(self)
+
+    def _write_batches(self) -> None:
+        sys.setprofile(None)
+        UNTRACED_THREADS.add(threading.get_ident())
+        try:
+            while True:
+                batch = self.queue.get()
+                try:
+                    if batch is _STOP:
+                        return
+                    start = time.perf_counter()
+                    self.store.add(batch)
+                    self.write_seconds += time.perf_counter() - start
+                    self.rows_written += len(batch)
+                except Exception:
+                    self.failed_writes += 1
+                    logger.exception("Failed to store traces")
+                finally:
+                    self.queue.task_done()
+        finally:
+            UNTRACED_THREADS.discard(threading.get_ident())
+
+    def _enqueue(self, batch: List[CallTrace]) -> None:
+        # The writer thread stores a snapshot of each trace, so that a
+        # CallTracer with a signature cache can keep counting calls on the
+        # original (and log it again once its count has been handed off).
+        snapshot = []
+        for trace in batch:
+            snapshot.append(copy.copy(trace))
+            trace.count = 0
+        if self.writer is None:
+            self.writer = threading.Thread(target=self._write_batches, name='monkeytype-writer', daemon=True)
+            self.writer.start()
+        if self.overflow_policy is OverflowPolicy.BLOCK:
+            self.queue.put(snapshot)
+            return
+        while True:
+            try:
+                self.queue.put_nowait(snapshot)
+                return
+            except queue.Full:
+                if self.overflow_policy is OverflowPolicy.DROP_NEWEST:
+                    self.dropped_traces += len(snapshot)
+                    return
+            try:
+                dropped = self.queue.get_nowait()
+            except queue.Empty:
+                continue
+            self.dropped_traces += len(dropped)
+            self.queue.task_done()
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            'logged': self.logged_traces,
+            'buffered': len(self.traces),
+            'queued_batches': self.queue.qsize(),
+            'dropped': self.dropped_traces,
+            'failed_writes': self.failed_writes,
+            'rows_written': self.rows_written,
+            'write_seconds': self.write_seconds,
+        }
 
     def log(self, trace: CallTrace) -> None:
-        if not trace.func.__module__ == '__main__':
-            self.traces.append(trace)
+        if trace.func.__module__ == '__main__':
+            return
+        self.logged_traces += 1
+        self.traces.append(trace)
+        if len(self.traces) >= self.batch_size:
+            batch, self.traces = self.traces, []
+            self._enqueue(batch)
 
     def flush(self) -> None:
-        self.store.add(self.traces)
-        self.traces = []
+        if self.traces:
+            batch, self.traces = self.traces, []
+            self._enqueue(batch)
+        if self.writer is not None and self.writer.is_alive():
+            self.queue.join()
+
+    def close(self) -> None:
+        """Store all logged traces and stop the writer thread."""
+        self.flush()
+        if self.writer is None:
+            return
+        if self.writer.is_alive():
+            self.queue.put(_STOP)
+            self.writer.join()
+        self.writer = None
@@ -39,10 +39,15 @@ CREATE TABLE IF NOT EXISTS {table} (
   qualname    TEXT,
   arg_types   TEXT,
   return_type TEXT,
-  yield_type  TEXT);
+  yield_type  TEXT,
+  call_count  INTEGER DEFAULT 1);
 """.format(table=table)
     with conn:
         conn.execute(query)
+        # Tables created before call counts were recorded lack the column.
+        columns = [row[1] for row in conn.execute('PRAGMA table_info({table})'.format(table=table))]
+        if 'call_count' not in columns:
+            conn.execute('ALTER TABLE {table} ADD COLUMN call_count INTEGER DEFAULT 1'.format(table=table))
 
 
 QueryValue = Union[str, int]
@@ -52,7 +57,7 @@ ParameterizedQuery = Tuple[str, List[QueryValue]]
 def make_query(table: str, module: str, qualname: Optional[str], limit: int) -> ParameterizedQuery:
     raw_query = """
     SELECT
-        module, qualname, arg_types, return_type, yield_type
+        module, qualname, arg_types, return_type, yield_type, SUM(call_count)
     FROM {table}
     WHERE
         module == ?
@@ -78,7 +83,8 @@ class SQLiteStore(CallTraceStore):
 
     @classmethod
     def make_store(cls, connection_string: str) -> 'CallTraceStore':
-        conn = sqlite3.connect(connection_string)
+        # Allow a BackgroundCallTraceStoreLogger to write from its own thread.
+        conn = sqlite3.connect(connection_string, check_same_thread=False)
         create_call_trace_table(conn)
         return cls(conn)
 
@@ -86,10 +92,12 @@ class SQLiteStore(CallTraceStore):
         values = []
         for row in serialize_traces(traces):
             values.append((datetime.datetime.now(), row.module, row.qualname,
-                           row.arg_types, row.return_type, row.yield_type))
+                           row.arg_types, row.return_type, row.yield_type, row.count))
         with self.conn:
             self.conn.executemany(
-                'INSERT INTO {table} VALUES (?, ?, ?, ?, ?, ?)'.format(table=self.table),
+                """INSERT INTO {table}
+                (created_at, module, qualname, arg_types, return_type, yield_type, call_count)
+                VALUES (?, ?, ?, ?, ?, ?, ?)""".format(table=self.table),
                 values
             )
 
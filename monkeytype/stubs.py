@@ -53,6 +53,7 @@ from monkeytype.typing import (
     NoneType,
     NoOpRewriter,
     TypeRewriter,
+    make_async_iterator,
     make_generator,
     make_iterator,
     shrink_types,
@@ -194,6 +195,7 @@ def update_signature_return(
     return_type: type = None,
     yield_type: type = None,
     existing_annotation_strategy: ExistingAnnotationStrategy = ExistingAnnotationStrategy.REPLICATE,
+    is_async_generator: bool = False,
 ) -> inspect.Signature:
     """Update return annotation with the supplied types"""
     anno = sig.return_annotation
@@ -208,8 +210,11 @@ def update_signature_return(
             return sig
     # NB: We cannot distinguish between functions that explicitly only
     # return None and those that do so implicitly. In the case of generator
-    # functions both are typed as Iterator[<yield_type>]
-    if (yield_type is not None) and ((return_type is None) or (return_type == NoneType)):
+    # functions both are typed as Iterator[<yield_type>]. Async generators
+    # can't return a value, so they are always AsyncIterator[<yield_type>].
+    if (yield_type is not None) and is_async_generator:
+        anno = make_async_iterator(yield_type)
+    elif (yield_type is not None) and ((return_type is None) or (return_type == NoneType)):
         anno = make_iterator(yield_type)
     elif (yield_type is not None) and (return_type is not None):
         anno = make_generator(yield_type, NoneType, return_type)
@@ -690,7 +695,7 @@ class FunctionDefinition:
     def from_callable(cls, func: Callable, kind: FunctionKind = None) -> 'FunctionDefinition':
         kind = FunctionKind.from_callable(func)
         sig = inspect.Signature.from_callable(func)
-        is_async = asyncio.iscoroutinefunction(func)
+        is_async = asyncio.iscoroutinefunction(func) or inspect.isasyncgenfunction(func)
         return FunctionDefinition(func.__module__, func.__qualname__, kind, sig, is_async)
 
     @classmethod
@@ -726,7 +731,8 @@ class FunctionDefinition:
         signature = update_signature_args(signature, new_arg_types,
                                           function.has_self, existing_annotation_strategy)
         signature = update_signature_return(signature, return_type,
-                                            yield_type, existing_annotation_strategy)
+                                            yield_type, existing_annotation_strategy,
+                                            is_async_generator=inspect.isasyncgenfunction(func))
         return FunctionDefinition(function.module, function.qualname,
                                   function.kind, signature,
                                   function.is_async, typed_dict_class_stubs)
@@ -3,15 +3,19 @@
 #
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree.
+import gc
 import inspect
 import logging
 import opcode
 import random
 import sys
+import threading
+import time
 from abc import (
     ABCMeta,
     abstractmethod,
 )
+from collections import OrderedDict, deque
 from contextlib import contextmanager
 from types import (
     CodeType,
@@ -20,9 +24,17 @@ from types import (
 from typing import (
     Any,
     Callable,
+    Collection,
+    Deque,
     Dict,
     Iterator,
+    List,
+    Mapping,
+    NamedTuple,
     Optional,
+    Set,
+    Tuple,
+    Type,
     Union,
     cast,
 )
@@ -32,12 +44,23 @@ try:
 except ImportError:
     cached_property = None
 
-from monkeytype.typing import get_type
+from monkeytype.typing import (
+    TYPE_HANDLERS,
+    ImmutableTypeCache,
+    TypeBudget,
+    TypeHandler,
+    get_elements_type,
+    get_shallow_type,
+    get_type,
+)
 from monkeytype.util import get_func_fqname
 
 
 logger = logging.getLogger(__name__)
 
+# sys.monitoring (PEP 669) only exists on Python 3.12+
+_monitoring: Any = getattr(sys, 'monitoring', None)
+
 
 class CallTrace:
     """CallTrace contains the types observed during a single invocation of a function"""
@@ -47,7 +70,10 @@ class CallTrace:
         func: Callable,
         arg_types: Dict[str, type],
         return_type: Optional[type] = None,
-        yield_type: Optional[type] = None
+        yield_type: Optional[type] = None,
+        count: int = 1,
+        sampled: bool = False,
+        shallow: bool = False,
     ) -> None:
         """
         Args:
@@ -57,15 +83,35 @@ class CallTrace:
                 due to an unhandled exception. It will be NoneType if the function returns the value None.
             yield_type: The collected yield type. This will be None if the called function never
                 yields. It will be NoneType if the function yields the value None.
+            count: The number of calls observed with exactly these types. A CallTracer with a
+                signature cache increments this instead of logging a new trace for repeated calls;
+                loggers that persist traces reset it to 0 once the calls have been stored.
+            sampled: Whether some of the types were inferred from only part of a value.
+            shallow: Whether the types were taken without looking inside values, so that
+                builtin containers are typed as C[Any].
+
+        The types of yielded values are collected in `yield_types`, which maps each
+        distinct type to the number of times it was yielded; `yield_type` is their
+        union, built when it is first read. `yields` counts the values yielded, typed
+        or not.
         """
         self.func = func
         self.arg_types = arg_types
         self.return_type = return_type
+        self._yield_type: Optional[type] = None
+        self.yield_types: Dict[type, int] = {}
         self.yield_type = yield_type
+        self.yields = 0
+        self.count = count
+        self.sampled = sampled
+        self.shallow = shallow
 
     def __eq__(self, other: object) -> bool:
         if isinstance(other, self.__class__):
-            return self.__dict__ == other.__dict__
+            return (
+                (self.func, self.arg_types, self.return_type, self.yield_type) ==
+                (other.func, other.arg_types, other.return_type, other.yield_type)
+            )
         return NotImplemented
 
     def __repr__(self) -> str:
@@ -74,11 +120,26 @@ class CallTrace:
     def __hash__(self) -> int:
         return hash((self.func, frozenset(self.arg_types.items()), self.return_type, self.yield_type))
 
+    @property
+    def yield_type(self) -> Optional[type]:
+        if self._yield_type is None and self.yield_types:
+            types = tuple(self.yield_types)
+            self._yield_type = types[0] if len(types) == 1 else cast(type, Union[types])
+        return self._yield_type
+
+    @yield_type.setter
+    def yield_type(self, typ: Optional[type]) -> None:
+        self._yield_type = typ
+        self.yield_types = {} if typ is None else {typ: 1}
+
     def add_yield_type(self, typ: type) -> None:
-        if self.yield_type is None:
-            self.yield_type = typ
+        yield_types = self.yield_types
+        count = yield_types.get(typ)
+        if count is None:
+            yield_types[typ] = 1
+            self._yield_type = None
         else:
-            self.yield_type = cast(type, Union[self.yield_type, typ])
+            yield_types[typ] = count + 1
 
     @property
     def funcname(self) -> str:
@@ -100,7 +161,92 @@ class CallTraceLogger(metaclass=ABCMeta):
         simple loggers it may not be necessary to batch-flush traces, and `log`
         can handle everything.
         """
-        pass
+
+    def metrics(self) -> Dict[str, Any]:
+        """Return a snapshot of the logger's counters.
+
+        Not an abstractmethod; loggers without counters return an empty dict.
+        """
+        return {}
+
+    def close(self) -> None:
+        """Flush logged traces and release any resources, such as threads.
+
+        Called when a tracing block ends. Not an abstractmethod; by default it
+        just flushes. A closed logger must still accept traces.
+        """
+        self.flush()
+
+
+class ThreadLocalCallTraceLogger(CallTraceLogger):
+    """Buffer traces per thread before passing them on to another logger.
+
+    Threads append to their own buffer without taking any lock. A thread hands
+    its buffer to the wrapped `logger` once it holds `batch_size` traces, and
+    `flush` merges the buffers of all threads into `logger` before flushing
+    it. The wrapped logger is only ever called with the lock held.
+    """
+
+    def __init__(self, logger: CallTraceLogger, batch_size: int = 100) -> None:
+        self.logger = logger
+        self.batch_size = batch_size
+        self.local = threading.local()
+        self.lock = threading.RLock()
+        self.buffers: List[Tuple[threading.Thread, Deque[CallTrace]]] = []
+
+    def _get_buffer(self) -> Deque[CallTrace]:
+        try:
+            return self.local.buffer
+        except AttributeError:
+            buffer: Deque[CallTrace] = deque()
+            self.local.buffer = buffer
+            with self.lock:
+                self.buffers.append((threading.current_thread(), buffer))
+            return buffer
+
+    def _drain(self, buffer: Deque[CallTrace]) -> None:
+        while True:
+            try:
+                trace = buffer.popleft()
+            except IndexError:
+                return
+            self.logger.log(trace)
+
+    def metrics(self) -> Dict[str, Any]:
+        with self.lock:
+            buffered = sum(len(buffer) for _, buffer in self.buffers)
+        return {'buffered': buffered, 'logger': self.logger.metrics()}
+
+    def close(self) -> None:
+        self.flush()
+        with self.lock:
+            self.logger.close()
+
+    def log(self, trace: CallTrace) -> None:
+        buffer = self._get_buffer()
+        buffer.append(trace)
+        if len(buffer) >= self.batch_size:
+            with self.lock:
+                self._drain(buffer)
+
+    def flush(self) -> None:
+        with self.lock:
+            for _, buffer in self.buffers:
+                self._drain(buffer)
+            # Forget the buffers of threads that have exited
+            self.buffers = [(thread, buffer) for thread, buffer in self.buffers if thread.is_alive()]
+            self.logger.flush()
+
+
+def _unwrap_descriptor(val: Any) -> Callable:
+    """Return the function behind a class attribute, without invoking it."""
+    if isinstance(val, (classmethod, staticmethod)):
+        return val.__func__
+    elif isinstance(val, property) and (val.fset is None) and (val.fdel is None):
+        return cast(Callable, val.fget)
+    elif cached_property and isinstance(val, cached_property):
+        return cast(Callable, val.func)
+    return cast(Callable, val)
 
 
 def get_func_in_mro(obj: Any, code: CodeType) -> Optional[Callable]:
@@ -113,15 +259,7 @@ def get_func_in_mro(obj: Any, code: CodeType) -> Optional[Callable]:
     val = inspect.getattr_static(obj, code.co_name, None)
     if val is None:
         return None
-    if isinstance(val, (classmethod, staticmethod)):
-        cand = val.__func__
-    elif isinstance(val, property) and (val.fset is None) and (val.fdel is None):
-        cand = cast(Callable, val.fget)
-    elif cached_property and isinstance(val, cached_property):
-        cand = cast(Callable, val.func)
-    else:
-        cand = cast(Callable, val)
-    return _has_code(cand, code)
+    return _has_code(_unwrap_descriptor(val), code)
 
 
 def _has_code(func: Optional[Callable], code: CodeType) -> Optional[Callable]:
@@ -134,6 +272,124 @@ def _has_code(func: Optional[Callable], code: CodeType) -> Optional[Callable]:
     return None
 
 
+def _index_wrapped(index: Dict[CodeType, Callable], func: Any) -> None:
+    seen = set()
+    while func is not None and id(func) not in seen:
+        seen.add(id(func))
+        code = getattr(func, '__code__', None)
+        if isinstance(code, CodeType):
+            index.setdefault(code, func)
+        func = getattr(func, '__wrapped__', None)
+
+
+def _index_value(index: Dict[CodeType, Callable], classes: List[type], val: Any, is_member: bool) -> None:
+    # Proxies and lazy objects may raise anything when their attributes (even
+    # __class__) are looked up, and must not keep the rest of the namespace
+    # from being indexed.
+    try:
+        if isinstance(val, type):
+            classes.append(val)
+        elif is_member:
+            _index_wrapped(index, _unwrap_descriptor(val))
+        elif callable(val):
+            _index_wrapped(index, val)
+    except Exception:
+        pass
+
+
+def index_module_code(namespace: Dict[str, Any]) -> Dict[CodeType, Callable]:
+    """Map the code objects of the functions reachable from a module namespace
+    to those functions.
+
+    This covers module-level functions, methods (including static and class
+    methods and read-only properties) of module-level and nested classes and
+    their bases, and the functions they decorate through `__wrapped__`.
+    """
+    index: Dict[CodeType, Callable] = {}
+    classes: List[type] = []
+    for v in list(namespace.values()):
+        _index_value(index, classes, v, is_member=False)
+    seen_classes = set()
+    while classes:
+        cls = classes.pop()
+        if cls in seen_classes:
+            continue
+        seen_classes.add(cls)
+        for klass in cls.__mro__:
+            for val in list(vars(klass).values()):
+                _index_value(index, classes, val, is_member=True)
+    return index
+
+
+# The most namespaces whose code indexes are kept
+MAX_MODULE_CODE_INDEXES = 256
+
+
+class ModuleCodeIndex(NamedTuple):
+    """The code index of a module namespace."""
+
+    # The namespace itself, so that its id isn't reused while it's indexed
+    namespace: Dict[str, Any]
+    # A copy of the namespace when it was indexed
+    bindings: Dict[str, Any]
+    # The functions reachable from the namespace by their code objects
+    codes: Dict[CodeType, Callable]
+    # Code objects looked up and not found since the namespace was indexed
+    misses: Set[CodeType]
+
+
+# Code indexes of module namespaces, keyed by the id of the namespace dict,
+# least recently used first. A namespace that has since grown or shrunk is
+# re-indexed.
+_module_code_indexes: 'OrderedDict[int, ModuleCodeIndex]' = OrderedDict()
+
+
+def _index_namespace(namespace: Dict[str, Any]) -> ModuleCodeIndex:
+    entry = ModuleCodeIndex(namespace, dict(namespace), index_module_code(namespace), set())
+    _module_code_indexes[id(namespace)] = entry
+    _module_code_indexes.move_to_end(id(namespace))
+    while len(_module_code_indexes) > MAX_MODULE_CODE_INDEXES:
+        _module_code_indexes.popitem(last=False)
+    return entry
+
+
+def _get_namespace_index(namespace: Dict[str, Any]) -> ModuleCodeIndex:
+    entry = _module_code_indexes.get(id(namespace))
+    if entry is None or entry.namespace is not namespace or len(entry.bindings) != len(namespace):
+        return _index_namespace(namespace)
+    _module_code_indexes.move_to_end(id(namespace))
+    return entry
+
+
+def _is_rebound(namespace: Dict[str, Any], bindings: Dict[str, Any]) -> bool:
+    if len(namespace) != len(bindings):
+        return True
+    for name, val in bindings.items():
+        if name not in namespace or namespace[name] is not val:
+            return True
+    return False
+
+
+def get_module_code_index(namespace: Dict[str, Any]) -> Dict[CodeType, Callable]:
+    return _get_namespace_index(namespace).codes
+
+
+def get_func_in_module(namespace: Dict[str, Any], code: CodeType) -> Optional[Callable]:
+    """Return the function reachable from a module namespace whose code is `code`, if any."""
+    entry = _get_namespace_index(namespace)
+    func = entry.codes.get(code)
+    # Nested functions and lambdas are never in the index, so each code
+    # object is only looked for again once the namespace has changed. Names
+    # may have been rebound without changing its size.
+    if func is None and code not in entry.misses:
+        if _is_rebound(namespace, entry.bindings):
+            entry = _index_namespace(namespace)
+            func = entry.codes.get(code)
+        if func is None:
+            entry.misses.add(code)
+    return func
+
+
 def get_func(frame: FrameType) -> Optional[Callable]:
     """Return the function whose code object corresponds to the supplied stack frame."""
     code = frame.f_code
@@ -150,19 +406,107 @@ def get_func(frame: FrameType) -> Optional[Callable]:
         first_arg = frame.f_locals.get(code.co_varnames[0])
         func = get_func_in_mro(first_arg, code)
     # If we still can't find the function, as will be the case with static methods,
-    # try looking at classes in global scope.
+    # look it up in the index of functions reachable from the module's globals.
     if func is None:
-        for v in frame.f_globals.values():
-            if not isinstance(v, type):
-                continue
-            func = get_func_in_mro(v, code)
-            if func is not None:
-                break
+        func = get_func_in_module(frame.f_globals, code)
     return func
 
 
-RETURN_VALUE_OPCODE = opcode.opmap['RETURN_VALUE']
+# The argument, return, and yield types that identify a distinct trace of a code object.
+Signature = Tuple[Tuple[Tuple[str, type], ...], Optional[type], Optional[type]]
+
+
+def get_signature(trace: CallTrace) -> Signature:
+    return (tuple(trace.arg_types.items()), trace.return_type, trace.yield_type)
+
+
+RETURN_OPCODES = {opcode.opmap[name] for name in ('RETURN_VALUE', 'RETURN_CONST') if name in opcode.opmap}
 YIELD_VALUE_OPCODE = opcode.opmap['YIELD_VALUE']
+# Python < 3.11 suspends on YIELD_FROM for `yield from` and `await`
+YIELD_FROM_OPCODE = opcode.opmap.get('YIELD_FROM')
+# Python >= 3.11 starts and resumes frames at RESUME; its argument is 0 on start
+RESUME_OPCODE = opcode.opmap.get('RESUME')
+
+# Code objects whose frames can be suspended and resumed
+CO_SUSPENDABLE = (
+    inspect.CO_GENERATOR | inspect.CO_COROUTINE | inspect.CO_ITERABLE_COROUTINE | inspect.CO_ASYNC_GENERATOR
+)
+# Code objects that suspend only to await
+CO_AWAITING = inspect.CO_COROUTINE | inspect.CO_ITERABLE_COROUTINE
+
+# Values yielded by an async generator are wrapped in this type before they
+# leave the frame. Anything else an async generator frame suspends with is
+# passed up from an `await`.
+ASYNC_GEN_WRAPPED_VALUE_NAME = 'async_generator_wrapped_value'
+
+
+def is_resumption(frame: FrameType) -> bool:
+    """Return whether a call event is a suspended generator or coroutine frame resuming."""
+    if RESUME_OPCODE is None:
+        return frame.f_lasti >= 0
+    co_code = frame.f_code.co_code
+    return co_code[frame.f_lasti] == RESUME_OPCODE and co_code[frame.f_lasti + 1] != 0
+
+
+def is_suspension(frame: FrameType) -> bool:
+    """Return whether a return event is a generator or coroutine frame suspending."""
+    co_code = frame.f_code.co_code
+    lasti = frame.f_lasti
+    if co_code[lasti] == YIELD_VALUE_OPCODE:
+        return True
+    # Python >= 3.13 has already moved f_lasti on to the RESUME (with a
+    # nonzero argument) that follows the YIELD_VALUE.
+    if (
+        co_code[lasti] == RESUME_OPCODE and co_code[lasti + 1] != 0 and
+        lasti >= 2 and co_code[lasti - 2] == YIELD_VALUE_OPCODE
+    ):
+        return True
+    # While suspended on YIELD_FROM, f_lasti points at the preceding
+    # instruction, so that YIELD_FROM runs again when the frame resumes.
+    return YIELD_FROM_OPCODE is not None and lasti + 2 < len(co_code) and co_code[lasti + 2] == YIELD_FROM_OPCODE
+
+
+class ArgLayout(NamedTuple):
+    """The names of the parameters of a code object, by kind."""
+
+    # Positional and keyword-only parameters
+    named: Tuple[str, ...]
+    # The *args and **kwargs parameters, if any
+    var_positional: Optional[str]
+    var_keyword: Optional[str]
+
+
+def get_arg_layout(code: CodeType) -> ArgLayout:
+    """Return the parameters of `code`, which precede its other locals in co_varnames."""
+    varnames = code.co_varnames
+    num_named = code.co_argcount + code.co_kwonlyargcount
+    var_positional = var_keyword = None
+    index = num_named
+    if code.co_flags & inspect.CO_VARARGS:
+        var_positional = varnames[index]
+        index += 1
+    if code.co_flags & inspect.CO_VARKEYWORDS:
+        var_keyword = varnames[index]
+    return ArgLayout(varnames[:num_named], var_positional, var_keyword)
+
+
+# The most in-flight traces a CallTracer keeps per thread
+MAX_IN_FLIGHT_TRACES = 10000
+
+# At most this many values passed to a *args or **kwargs parameter are typed
+# per call. Tracing is often started around code that forwards large
+# collections of arguments, and typing each of them adds up.
+MAX_VARIADIC_VALUES = 64
+
+
+def unwrap_async_gen_value(value: Any) -> Any:
+    """Return the value wrapped by an async_generator_wrapped_value.
+
+    The wrapper doesn't expose the value, but reports it to the garbage
+    collector as its only referent.
+    """
+    return gc.get_referents(value)[0]
+
 
 # A CodeFilter is a predicate that decides whether or not a the call for the
 # supplied code object should be traced.
@@ -172,6 +516,314 @@ EVENT_CALL = 'call'
 EVENT_RETURN = 'return'
 SUPPORTED_EVENTS = {EVENT_CALL, EVENT_RETURN}
 
+# Idents of threads that must never be traced, such as the writer threads of
+# trace loggers (tracing them would log the act of storing traces).
+UNTRACED_THREADS: Set[int] = set()
+
+_MASK64 = (1 << 64) - 1
+
+
+class FastRandom:
+    """A 64-bit linear congruential pseudo-random number generator.
+
+    Drawing a number costs a multiply, an add and a shift, which is much
+    cheaper than a call into the random module, and needs no locking: threads
+    racing on the state just get correlated numbers. The low bits of an LCG
+    are weak, so only the high 31 bits are returned.
+
+    Without a `seed`, the generator is seeded from the random module, so that
+    separate runs draw different numbers.
+    """
+
+    def __init__(self, seed: Optional[int] = None) -> None:
+        if seed is None:
+            seed = random.getrandbits(64)
+        self.state = seed & _MASK64
+
+    def next(self) -> int:
+        """Return the next pseudo-random 31-bit integer."""
+        self.state = state = (self.state * 6364136223846793005 + 1442695040888963407) & _MASK64
+        return state >> 33
+
+
+class GovernorWindow(NamedTuple):
+    """The tracing overhead measured over one window of process CPU time."""
+
+    # When the window ended, as a Unix timestamp
+    timestamp: float
+    # The estimated fraction of the window's CPU time spent tracing
+    overhead: float
+    # The throttle level and pause state chosen for the next window
+    level: int
+    paused: bool
+
+
+class OverheadGovernor:
+    """Keeps the CPU time spent tracing within a fraction of the process's CPU time.
+
+    1 in `measure_every` tracer events are timed with perf_counter_ns, and the
+    time spent tracing is extrapolated from them. At the end of each window of
+    `window` seconds of process CPU time, the estimated overhead is compared
+    with `budget`. Over budget, the throttle level goes up by one, and at
+    `max_level` tracing pauses for `pause` seconds of CPU time instead. Under
+    half the budget, the level goes back down by one. At level L, only 1 in 2**L
+    calls is traced.
+
+    `level` and `paused` are the current state, and `history` holds the last
+    `history_size` windows.
+    """
+
+    def __init__(
+        self,
+        budget: float,
+        window: float = 1.0,
+        measure_every: int = 16,
+        max_level: int = 10,
+        pause: float = 10.0,
+        history_size: int = 64,
+    ) -> None:
+        self.budget = budget
+        self.window_ns = int(window * 1e9)
+        self.measure_every = measure_every
+        self.max_level = max_level
+        self.pause_ns = int(pause * 1e9)
+        self.level = 0
+        self.paused = False
+        self.history: Deque[GovernorWindow] = deque(maxlen=history_size)
+        self.mask = 0
+        self.calls = 0
+        self.events = 0
+        self.spent_ns = 0
+        self.window_start_ns = time.process_time_ns()
+        self.paused_until_ns = 0
+
+    def admit(self) -> bool:
+        """Return whether the current throttle level lets a call be traced."""
+        if self.paused:
+            return False
+        self.calls += 1
+        return self.calls & self.mask == 0
+
+    def tick(self) -> bool:
+        """Count a tracer event, and return whether to time it."""
+        self.events += 1
+        return self.events % self.measure_every == 0
+
+    def record(self, elapsed_ns: int) -> None:
+        """Record the time taken by a timed event, and adjust at the end of a window."""
+        self.spent_ns += elapsed_ns * self.measure_every
+        now_ns = time.process_time_ns()
+        window_ns = now_ns - self.window_start_ns
+        if window_ns < self.window_ns or window_ns <= 0:
+            return
+        overhead = self.spent_ns / window_ns
+        if self.paused:
+            if now_ns >= self.paused_until_ns:
+                self.paused = False
+        elif overhead > self.budget:
+            if self.level < self.max_level:
+                self.level += 1
+            else:
+                self.paused = True
+                self.paused_until_ns = now_ns + self.pause_ns
+        elif overhead < self.budget / 2 and self.level > 0:
+            self.level -= 1
+        self.mask = (1 << self.level) - 1
+        self.history.append(GovernorWindow(time.time(), overhead, self.level, self.paused))
+        self.spent_ns = 0
+        self.window_start_ns = now_ns
+
+
+class MetricsReporter:
+    """Calls `callback` with a snapshot of a tracer's metrics every `interval` seconds.
+
+    The callback runs on a dedicated, untraced thread while the tracer is
+    installed, and once more with the final metrics when it's removed.
+    """
+
+    def __init__(self, callback: Callable[[Dict[str, Any]], None], interval: float = 60.0) -> None:
+        self.callback = callback
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def report(self, tracer: 'CallTracer') -> None:
+        try:
+            self.callback(tracer.metrics())
+        except Exception:
+            logger.exception("Failed reporting tracer metrics")
+
+    def _run(self, tracer: 'CallTracer') -> None:
+        sys.setprofile(None)
+        UNTRACED_THREADS.add(threading.get_ident())
+        try:
+            while not self.stopped.wait(self.interval):
+                self.report(tracer)
+        finally:
+            UNTRACED_THREADS.discard(threading.get_ident())
+
+    def start(self, tracer: 'CallTracer') -> None:
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target=self._run, args=(tracer,), name='monkeytype-metrics', daemon=True)
+        self.thread.start()
+
+    def stop(self, tracer: 'CallTracer') -> None:
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        self.report(tracer)
+
+
+# 1 in this many get_type calls of a CallTracer are timed for its metrics
+GET_TYPE_TIMING_RATE = 64
+
+
+class Convergence:
+    """When to consider the types of a function settled and stop tracing it.
+
+    A code object converges once `calls` traced calls in a row, or all the
+    calls traced over `seconds`, have had signatures already seen for it. It
+    is traced again after `recheck_interval` seconds (never, if None). Up to
+    `max_signatures` distinct signatures are remembered per code object; a
+    function seen with more than that keeps being traced.
+    """
+
+    def __init__(
+        self,
+        calls: Optional[int] = 1000,
+        seconds: Optional[float] = None,
+        recheck_interval: Optional[float] = 600.0,
+        max_signatures: int = 64,
+    ) -> None:
+        self.calls = calls
+        self.seconds = seconds
+        self.recheck_interval = recheck_interval
+        self.max_signatures = max_signatures
+
+
+class _Stability:
+    """How long the signatures of one code object have been stable."""
+
+    __slots__ = ('signatures', 'calls', 'since')
+
+    def __init__(self, since: float) -> None:
+        self.signatures: Set[Signature] = set()
+        self.calls = 0
+        self.since = since
+
+
+class TracingCost:
+    """Time a CallTracer spent handling the events of one code object.
+
+    `handler_ns` covers all the handling of its call, return and yield events,
+    including the `get_type_ns` spent inferring the types of its arguments,
+    return values and yielded values.
+    """
+
+    __slots__ = ('events', 'calls', 'handler_ns', 'get_type_ns')
+
+    def __init__(self) -> None:
+        self.events = 0
+        self.calls = 0
+        self.handler_ns = 0
+        self.get_type_ns = 0
+
+
+class SamplingPolicy(metaclass=ABCMeta):
+    """Decides which calls a CallTracer traces.
+
+    `sample` is called with the frame of every call that passes the code
+    filter, before the called function is looked up, so it must be cheap.
+    """
+
+    @abstractmethod
+    def sample(self, frame: FrameType) -> bool:
+        """Return whether to trace the call running in `frame`."""
+        pass
+
+
+class RateSamplingPolicy(SamplingPolicy):
+    """Trace 1 in `rate` calls of every function, at random."""
+
+    def __init__(self, rate: int, seed: Optional[int] = None) -> None:
+        self.rate = rate
+        self.random = FastRandom(seed)
+
+    def sample(self, frame: FrameType) -> bool:
+        return self.random.next() % self.rate == 0
+
+
+class _CodeSampling:
+    """The sampling state of one code object."""
+
+    __slots__ = ('calls', 'rate', 'decay_at')
+
+    def __init__(self, rate: int, decay_at: int) -> None:
+        self.calls = 0
+        self.rate = rate
+        # The number of calls at which the rate next doubles
+        self.decay_at = decay_at
+
+
+class AdaptiveSamplingPolicy(SamplingPolicy):
+    """Trace the first calls of each function, then fewer and fewer of them.
+
+    The first `warmup` calls of each code object are always traced. After
+    that, 1 in 2 calls are traced, then 1 in 4 once `half_life` more calls
+    have been made, and so on, down to 1 in `max_rate`. Rarely called
+    functions are thus traced every time, while hot ones don't flood the
+    store.
+
+    `module_rates` maps module names to a fixed 1-in-N rate that replaces the
+    decay, after the warmup, for code in those modules and their submodules;
+    the longest matching name wins. Each decision is O(1): a dict lookup, a
+    counter increment and a FastRandom draw.
+    """
+
+    def __init__(
+        self,
+        warmup: int = 16,
+        half_life: int = 256,
+        max_rate: int = 1024,
+        module_rates: Optional[Mapping[str, int]] = None,
+        seed: Optional[int] = None,
+    ) -> None:
+        self.warmup = warmup
+        self.half_life = half_life
+        self.max_rate = max_rate
+        self.module_rates = dict(module_rates or {})
+        self.random = FastRandom(seed)
+        self.codes: Dict[CodeType, _CodeSampling] = {}
+
+    def module_rate(self, module: str) -> Optional[int]:
+        """Return the configured rate for `module`, if any."""
+        while True:
+            rate = self.module_rates.get(module)
+            if rate is not None or '.' not in module:
+                return rate
+            module = module.rpartition('.')[0]
+
+    def sample(self, frame: FrameType) -> bool:
+        code = frame.f_code
+        state = self.codes.get(code)
+        if state is None:
+            rate = self.module_rate(frame.f_globals.get('__name__') or '')
+            if rate is None:
+                state = _CodeSampling(1, self.warmup + 1)
+            else:
+                state = _CodeSampling(rate, sys.maxsize)
+            self.codes[code] = state
+        state.calls = calls = state.calls + 1
+        if calls <= self.warmup:
+            return True
+        if calls >= state.decay_at:
+            state.rate = min(state.rate * 2, self.max_rate)
+            state.decay_at = sys.maxsize if state.rate == self.max_rate else calls + self.half_life
+        return self.random.next() % state.rate == 0
+
 
 class CallTracer:
     """CallTracer captures the concrete types involved in a function invocation.
@@ -185,6 +837,50 @@ class CallTracer:
 
         sys.setprofile(CallTracer(MyCallLogger()))
 
+    If `all_threads` is true, `start` installs the tracer on every thread.
+    In-flight traces are always kept per thread.
+
+    If a `type_budget` is given, each argument, return and yield value is typed
+    within a fresh copy of it, and traces whose types were sampled are marked.
+    With an `immutable_type_cache_size`, the types of up to that many deeply
+    immutable tuples are remembered by identity (see ImmutableTypeCache).
+
+    With a `deep_sample_rate` of N, only 1/N traced calls have their values
+    typed in full; the rest get cheap shallow types (see get_shallow_type) and
+    are marked as shallow.
+
+    A `sampling_policy` decides which calls are traced (see SamplingPolicy);
+    a `sample_rate` of N without one traces 1 in N calls at random.
+
+    With a `convergence`, code objects whose signatures have stopped changing
+    are added to `converged`, which maps them to when they'll be traced again.
+    Calls of converged code are ignored before any other work is done.
+    Reloading a module creates new code objects, which are traced afresh.
+
+    With a `yield_sample_threshold` of N, a call's first N yielded values are
+    typed, and after that only the ones whose position is a power of two; the
+    traces of such calls are marked as sampled.
+
+    In-flight traces are keyed by the id of their frame, so that tracing never
+    keeps frames (and their locals) alive. A frame that goes away without a
+    return event, such as that of a generator that is never exhausted or of a
+    greenlet that is never switched back to, leaves an abandoned trace behind.
+    It is dropped when its frame's id is reused, or when more than
+    `max_in_flight` traces are in flight on a thread, oldest first; `abandoned`
+    counts the traces dropped either way.
+
+    With a `cpu_budget` (a fraction, such as 0.02 for 2%), a `governor`
+    throttles tracing to keep its CPU time within the budget (see
+    OverheadGovernor). Tracer events are only timed when the tracer was
+    installed with `start`.
+
+    `metrics` returns a snapshot of the tracer's counters, including those of
+    its logger. A `metrics_reporter` pushes it to a callback periodically
+    while the tracer is installed with `start`.
+
+    With `attribute_costs`, the time spent handling the events of each traced
+    code object, and inferring types for them, is added up in `costs` (see
+    TracingCost); `top_costs` returns the most expensive ones.
     """
 
     def __init__(
@@ -193,38 +889,328 @@ class CallTracer:
         max_typed_dict_size: int,
         code_filter: Optional[CodeFilter] = None,
         sample_rate: Optional[int] = None,
+        signature_cache_size: Optional[int] = None,
+        all_threads: bool = False,
+        type_budget: Optional[TypeBudget] = None,
+        immutable_type_cache_size: Optional[int] = None,
+        deep_sample_rate: Optional[int] = None,
+        yield_sample_threshold: Optional[int] = None,
+        sampling_policy: Optional[SamplingPolicy] = None,
+        convergence: Optional[Convergence] = None,
+        cpu_budget: Optional[float] = None,
+        metrics_reporter: Optional[MetricsReporter] = None,
+        attribute_costs: bool = False,
     ) -> None:
         self.logger = logger
-        self.traces: Dict[FrameType, CallTrace] = {}
+        self.local = threading.local()
+        self.all_threads = all_threads
         self.sample_rate = sample_rate
+        if sampling_policy is None and sample_rate:
+            sampling_policy = RateSamplingPolicy(sample_rate)
+        self.sampling_policy = sampling_policy
         self.cache: Dict[CodeType, Optional[Callable]] = {}
+        self.arg_layouts: Dict[CodeType, ArgLayout] = {}
         self.should_trace = code_filter
         self.max_typed_dict_size = max_typed_dict_size
+        self.signature_cache_size = signature_cache_size
+        self.type_budget = type_budget
+        self.deep_sample_rate = deep_sample_rate
+        # Picks the calls that are typed in full, given a deep_sample_rate
+        self.random = FastRandom()
+        self.yield_sample_threshold = yield_sample_threshold
+        self.type_cache = ImmutableTypeCache(immutable_type_cache_size) if immutable_type_cache_size else None
+        self.signatures: Dict[CodeType, 'OrderedDict[Signature, CallTrace]'] = {}
+        self.max_in_flight = MAX_IN_FLIGHT_TRACES
+        self.abandoned = 0
+        self.convergence = convergence
+        self.stability: Dict[CodeType, _Stability] = {}
+        self.converged: Dict[CodeType, float] = {}
+        # The earliest time a converged code object is due to be traced again
+        self.next_recheck = float('inf')
+        self.governor = None if cpu_budget is None else OverheadGovernor(cpu_budget)
+        self.metrics_reporter = metrics_reporter
+        # Set by stop, since threads started while the tracer was installed
+        # keep calling it.
+        self.stopped = False
+        self.costs: Optional[Dict[CodeType, TracingCost]] = {} if attribute_costs else None
+        self.events = 0
+        self.filtered = 0
+        self.converged_calls = 0
+        self.unsampled = 0
+        self.traced = 0
+        self.logged = 0
+        self.deduplicated = 0
+        self.in_flight = 0
+        self.func_cache_hits = 0
+        self.func_cache_misses = 0
+        self.get_type_calls = 0
+        # Counts of timed get_type calls by the bit length of their duration in ns
+        self.get_type_histogram = [0] * 64
+        # Returns the type of a value observed during a trace. Typing values is
+        # the hottest part of tracing, so it is only counted and timed when
+        # the timings are reported or attributed.
+        self.get_type: Callable[[CallTrace, Any], type] = (
+            self._timed_get_type if metrics_reporter is not None or attribute_costs else self._get_type)
+
+    @property
+    def traces(self) -> Dict[int, Tuple[CodeType, CallTrace]]:
+        """The in-flight traces of the current thread and their code, keyed by id of frame."""
+        try:
+            return self.local.traces
+        except AttributeError:
+            traces = self.local.traces = {}
+            return traces
+
+    def push_trace(self, frame: FrameType, trace: CallTrace) -> None:
+        """Start tracking the trace of a call running in `frame`."""
+        traces = self.traces
+        key = id(frame)
+        if traces.pop(key, None) is not None:
+            # The frame of that trace is gone and its id has been reused.
+            self.abandoned += 1
+        else:
+            self.in_flight += 1
+        traces[key] = (frame.f_code, trace)
+        self.traced += 1
+        if len(traces) > self.max_in_flight:
+            del traces[next(iter(traces))]
+            self.abandoned += 1
+            self.in_flight -= 1
+
+    def get_trace(self, frame: FrameType) -> Optional[CallTrace]:
+        """Return the in-flight trace of the call running in `frame`, if any."""
+        traces = self.traces
+        entry = traces.get(id(frame))
+        if entry is None:
+            return None
+        if entry[0] is not frame.f_code:
+            del traces[id(frame)]
+            self.abandoned += 1
+            self.in_flight -= 1
+            return None
+        return entry[1]
+
+    def pop_trace(self, frame: FrameType) -> Optional[CallTrace]:
+        """Stop tracking and return the in-flight trace of the call running in `frame`, if any."""
+        trace = self.get_trace(frame)
+        if trace is not None:
+            del self.traces[id(frame)]
+            self.in_flight -= 1
+        return trace
+
+    def observe_signature(self, code: CodeType, trace: CallTrace) -> None:
+        """Track whether the signatures of `code` have stopped changing."""
+        convergence = cast(Convergence, self.convergence)
+        now = time.monotonic()
+        stability = self.stability.get(code)
+        if stability is None:
+            stability = self.stability[code] = _Stability(now)
+        key = get_signature(trace)
+        try:
+            seen = key in stability.signatures
+        except TypeError:
+            # Unhashable types can't be remembered
+            seen = False
+        if not seen:
+            if len(stability.signatures) < convergence.max_signatures:
+                try:
+                    stability.signatures.add(key)
+                except TypeError:
+                    pass
+            stability.calls = 0
+            stability.since = now
+            return
+        stability.calls += 1
+        if (
+            (convergence.calls is not None and stability.calls >= convergence.calls) or
+            (convergence.seconds is not None and now - stability.since >= convergence.seconds)
+        ):
+            interval = convergence.recheck_interval
+            until = float('inf') if interval is None else now + interval
+            self.converged[code] = until
+            self.next_recheck = min(self.next_recheck, until)
+
+    def is_converged(self, code: CodeType) -> bool:
+        """Return whether `code` has converged, tracing it again once it's due for a recheck."""
+        until = self.converged.get(code)
+        if until is None:
+            return False
+        now = time.monotonic()
+        if now < until:
+            return True
+        del self.converged[code]
+        stability = self.stability[code]
+        stability.calls = 0
+        stability.since = now
+        return False
+
+    def timed(self, handler: Callable[..., Any]) -> Callable[..., Any]:
+        """Wrap an event handler so that the governor times some of its calls."""
+        governor = self.governor
+        if governor is None:
+            return handler
+
+        def timed_handler(*args: Any) -> Any:
+            if not governor.tick():
+                return handler(*args)
+            start = time.perf_counter_ns()
+            try:
+                return handler(*args)
+            finally:
+                governor.record(time.perf_counter_ns() - start)
+
+        return timed_handler
+
+    @contextmanager
+    def attributing(self, code: CodeType) -> Iterator[TracingCost]:
+        """Attribute the time spent handling an event of `code` to it."""
+        costs = cast(Dict[CodeType, TracingCost], self.costs)
+        cost = costs.get(code)
+        if cost is None:
+            cost = costs[code] = TracingCost()
+        cost.events += 1
+        self.local.cost = cost
+        start = time.perf_counter_ns()
+        try:
+            yield cost
+        finally:
+            cost.handler_ns += time.perf_counter_ns() - start
+            self.local.cost = None
+
+    def top_costs(self, limit: Optional[int] = None) -> List[Tuple[CodeType, TracingCost]]:
+        """Return the code objects that were the most expensive to trace, and their costs."""
+        costs = sorted((self.costs or {}).items(), key=lambda item: item[1].handler_ns, reverse=True)
+        return costs[:limit]
+
+    def _timed_get_type(self, trace: CallTrace, value: Any) -> type:
+        self.get_type_calls += 1
+        timed = not self.get_type_calls % GET_TYPE_TIMING_RATE
+        cost = None if self.costs is None else getattr(self.local, 'cost', None)
+        if not timed and cost is None:
+            return self._get_type(trace, value)
+        start = time.perf_counter_ns()
+        try:
+            return self._get_type(trace, value)
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            if timed:
+                self.get_type_histogram[min(elapsed.bit_length(), 63)] += 1
+            if cost is not None:
+                cost.get_type_ns += elapsed
+
+    def _get_type(self, trace: CallTrace, value: Any) -> type:
+        if trace.shallow:
+            return get_shallow_type(value, self.max_typed_dict_size)
+        budget = None if self.type_budget is None else self.type_budget.fresh()
+        if self.type_cache is None:
+            typ = get_type(value, self.max_typed_dict_size, budget)
+        else:
+            typ = self.type_cache.get_type(value, self.max_typed_dict_size, budget)
+        if budget is not None and budget.sampled:
+            trace.sampled = True
+        return typ
+
+    def get_variadic_type(self, trace: CallTrace, values: Collection[Any]) -> type:
+        """Return the union of the types of the values passed to a *args or **kwargs parameter."""
+        cost = None if self.costs is None else getattr(self.local, 'cost', None)
+        if cost is None:
+            return self._get_variadic_type(trace, values)
+        start = time.perf_counter_ns()
+        try:
+            return self._get_variadic_type(trace, values)
+        finally:
+            cost.get_type_ns += time.perf_counter_ns() - start
+
+    def _get_variadic_type(self, trace: CallTrace, values: Collection[Any]) -> type:
+        if len(values) > MAX_VARIADIC_VALUES:
+            values = TypeBudget(max_elements=MAX_VARIADIC_VALUES).sample(values)
+            trace.sampled = True
+        if trace.shallow:
+            types = tuple(dict.fromkeys(get_shallow_type(value, self.max_typed_dict_size) for value in values))
+            return cast(type, Union[types])
+        budget = None if self.type_budget is None else self.type_budget.fresh()
+        typ = get_elements_type(values, self.max_typed_dict_size, budget)
+        if budget is not None and budget.sampled:
+            trace.sampled = True
+        return typ
 
     def _get_func(self, frame: FrameType) -> Optional[Callable]:
         code = frame.f_code
-        if code not in self.cache:
+        if code in self.cache:
+            self.func_cache_hits += 1
+        else:
+            self.func_cache_misses += 1
             self.cache[code] = get_func(frame)
         return self.cache[code]
 
     def handle_call(self, frame: FrameType) -> None:
-        if self.sample_rate and random.randrange(self.sample_rate) != 0:
+        if self.all_threads and threading.get_ident() in UNTRACED_THREADS:
+            return
+        code = frame.f_code
+        # Resuming a generator or coroutine is not a new call. I can't figure
+        # out a way to access the value sent to a generator via send() from a
+        # stack frame.
+        if code.co_flags & CO_SUSPENDABLE and is_resumption(frame):
+            return
+        if (
+            (self.sampling_policy is not None and not self.sampling_policy.sample(frame)) or
+            (self.governor is not None and not self.governor.admit())
+        ):
+            self.unsampled += 1
+            # A trace left under this frame's id by a call of the same code
+            # must not be completed by this call's return.
+            if self.traces.pop(id(frame), None) is not None:
+                self.abandoned += 1
+                self.in_flight -= 1
             return
         func = self._get_func(frame)
         if func is None:
             return
-        code = frame.f_code
-        # I can't figure out a way to access the value sent to a generator via
-        # send() from a stack frame.
-        if code.co_code[frame.f_lasti] == YIELD_VALUE_OPCODE:
+        layout = self.arg_layouts.get(code)
+        if layout is None:
+            layout = self.arg_layouts[code] = get_arg_layout(code)
+        trace = CallTrace(func, {})
+        if self.deep_sample_rate and self.random.next() % self.deep_sample_rate != 0:
+            trace.shallow = True
+        # Depending on the Python version, each read of f_locals either copies
+        # the frame's locals into a dict or creates a new proxy for them.
+        f_locals = frame.f_locals
+        arg_types = trace.arg_types
+        for name in layout.named:
+            if name in f_locals:
+                arg_types[name] = self.get_type(trace, f_locals[name])
+        # Variadic parameters are annotated with the type of their values
+        var_positional = layout.var_positional
+        if var_positional is not None and f_locals.get(var_positional):
+            arg_types[var_positional] = self.get_variadic_type(trace, f_locals[var_positional])
+        var_keyword = layout.var_keyword
+        if var_keyword is not None and f_locals.get(var_keyword):
+            arg_types[var_keyword] = self.get_variadic_type(trace, f_locals[var_keyword].values())
+        self.push_trace(frame, trace)
+        if self.costs is not None:
+            self.costs[code].calls += 1
+
+    def handle_yield(self, code: CodeType, trace: CallTrace, value: Any) -> None:
+        """Record a value passed out of a suspending generator or coroutine frame.
+
+        Coroutines only suspend to await, so they never yield. Async
+        generators suspend both to await and to yield; only the latter pass
+        out wrapped values.
+        """
+        flags = code.co_flags
+        if flags & inspect.CO_ASYNC_GENERATOR:
+            if type(value).__name__ != ASYNC_GEN_WRAPPED_VALUE_NAME:
+                return
+            value = unwrap_async_gen_value(value)
+        elif flags & CO_AWAITING:
+            return
+        trace.yields += 1
+        yields = trace.yields
+        threshold = self.yield_sample_threshold
+        if threshold and yields > threshold and yields & (yields - 1):
+            trace.sampled = True
             return
-        arg_names = code.co_varnames[0:code.co_argcount]
-        arg_types = {}
-        for name in arg_names:
-            if name in frame.f_locals:
-                arg_types[name] = get_type(frame.f_locals[name],
-                                           max_typed_dict_size=self.max_typed_dict_size)
-        self.traces[frame] = CallTrace(func, arg_types)
+        trace.add_yield_type(self.get_type(trace, value))
 
     def handle_return(self, frame: FrameType, arg: Any) -> None:
         # In the case of a 'return' event, arg contains the return value, or
@@ -233,27 +1219,142 @@ class CallTracer:
         # from a function returning (or yielding) None. In the latter case, the
         # the last instruction that was executed should always be a return or a
         # yield.
-        typ = get_type(arg, max_typed_dict_size=self.max_typed_dict_size)
-        last_opcode = frame.f_code.co_code[frame.f_lasti]
-        trace = self.traces.get(frame)
+        trace = self.get_trace(frame)
         if trace is None:
             return
-        elif last_opcode == YIELD_VALUE_OPCODE:
-            trace.add_yield_type(typ)
+        code = frame.f_code
+        if code.co_flags & CO_SUSPENDABLE and is_suspension(frame):
+            self.handle_yield(code, trace, arg)
+            return
+        if code.co_code[frame.f_lasti] in RETURN_OPCODES:
+            trace.return_type = self.get_type(trace, arg)
+        del self.traces[id(frame)]
+        self.in_flight -= 1
+        self.log_trace(code, trace)
+
+    def log_trace(self, code: CodeType, trace: CallTrace) -> None:
+        """Log a completed trace, unless an identical one has already been logged.
+
+        When a signature cache is configured, the last `signature_cache_size`
+        distinct signatures seen for each code object are remembered. A trace
+        whose signature is cached only increments the count of the cached
+        trace. If that trace has been persisted in the meantime (its count was
+        reset to 0), it is logged again to carry the new calls.
+        """
+        if self.convergence is not None:
+            self.observe_signature(code, trace)
+        if self.signature_cache_size:
+            signatures = self.signatures.get(code)
+            if signatures is None:
+                signatures = self.signatures[code] = OrderedDict()
+            key = get_signature(trace)
+            try:
+                cached = signatures.get(key)
+            except TypeError:
+                # Unhashable types can't be cached
+                self.logged += 1
+                self.logger.log(trace)
+                return
+            if cached is not None:
+                signatures.move_to_end(key)
+                cached.count += 1
+                if cached.count == 1:
+                    self.logged += 1
+                    self.logger.log(cached)
+                else:
+                    self.deduplicated += 1
+                return
+            signatures[key] = trace
+            if len(signatures) > self.signature_cache_size:
+                signatures.popitem(last=False)
+        self.logged += 1
+        self.logger.log(trace)
+
+    def metrics(self) -> Dict[str, Any]:
+        """Return a snapshot of the tracer's counters and those of its logger."""
+        metrics: Dict[str, Any] = {
+            'events': self.events,
+            'filtered': self.filtered,
+            'converged_calls': self.converged_calls,
+            'unsampled': self.unsampled,
+            'traced': self.traced,
+            'logged': self.logged,
+            'deduplicated': self.deduplicated,
+            'abandoned': self.abandoned,
+            'in_flight': self.in_flight,
+            'func_cache_hits': self.func_cache_hits,
+            'func_cache_misses': self.func_cache_misses,
+            # Upper bounds in ns of the durations of timed get_type calls
+            'get_type_ns': {1 << bits: count for bits, count in enumerate(self.get_type_histogram) if count},
+            'logger': self.logger.metrics(),
+        }
+        if self.governor is not None:
+            metrics['governor_level'] = self.governor.level
+            metrics['governor_paused'] = self.governor.paused
+        if self.type_cache is not None:
+            metrics['type_cache'] = self.type_cache.info()._asdict()
+        return metrics
+
+    def start(self) -> None:
+        """Install the tracer as the profile function of the current thread.
+
+        With `all_threads`, the tracer is also installed for threads started
+        later and, where the interpreter supports it (Python 3.12+), for
+        threads that are already running.
+        """
+        self.stopped = False
+        if self.metrics_reporter is not None:
+            self.metrics_reporter.start(self)
+        self._old_profile = sys.getprofile()
+        profile = self.timed(self)
+        if not self.all_threads:
+            sys.setprofile(profile)
+            return
+        self._old_thread_profile = getattr(threading, 'getprofile', lambda: None)()
+        if hasattr(threading, 'setprofile_all_threads'):
+            threading.setprofile_all_threads(profile)
         else:
-            if last_opcode == RETURN_VALUE_OPCODE:
-                trace.return_type = typ
-            del self.traces[frame]
-            self.logger.log(trace)
+            threading.setprofile(profile)
+            sys.setprofile(profile)
+
+    def stop(self) -> None:
+        """Remove the tracer, restoring the previously installed profile function.
+
+        Before Python 3.12, the tracer can't be removed from threads that were
+        started while it was installed; it ignores their events from now on.
+        """
+        self.stopped = True
+        if not self.all_threads:
+            sys.setprofile(self._old_profile)
+        else:
+            if hasattr(threading, 'setprofile_all_threads'):
+                threading.setprofile_all_threads(None)
+            threading.setprofile(self._old_thread_profile)
+            sys.setprofile(self._old_profile)
+        if self.metrics_reporter is not None:
+            self.metrics_reporter.stop(self)
 
     def __call__(self, frame: FrameType, event: str, arg: Any) -> 'CallTracer':
+        if self.stopped:
+            return self
+        self.events += 1
         code = frame.f_code
-        if (
-            event not in SUPPORTED_EVENTS or
-            code.co_name == 'trace_types' or
-            self.should_trace and not self.should_trace(code)
-        ):
+        if event == EVENT_CALL and self.converged and self.is_converged(code):
+            self.converged_calls += 1
+            return self
+        if event not in SUPPORTED_EVENTS:
             return self
+        if code.co_name == 'trace_types' or self.should_trace and not self.should_trace(code):
+            self.filtered += 1
+            return self
+        if self.costs is None:
+            self.handle_event(frame, event, arg)
+        else:
+            with self.attributing(code):
+                self.handle_event(frame, event, arg)
+        return self
+
+    def handle_event(self, frame: FrameType, event: str, arg: Any) -> None:
         try:
             if event == EVENT_CALL:
                 self.handle_call(frame)
@@ -263,7 +1364,241 @@ class CallTracer:
                 logger.error("Cannot handle event %s", event)
         except Exception:
             logger.exception("Failed collecting trace")
-        return self
+
+
+class MonitoringCallTracer(CallTracer):
+    """A CallTracer that receives events through sys.monitoring (PEP 669).
+
+    Instead of routing every call and return in the process through a Python
+    profile function, this registers PY_START, PY_RETURN, PY_YIELD and
+    PY_UNWIND callbacks and returns DISABLE for code objects that are rejected
+    by the code filter (or that don't correspond to a function we can find).
+    Disabled code objects cost nothing after their first call, and return and
+    yield events are only enabled locally for code objects that are traced.
+    Converged code objects (see `convergence`) are disabled too; once one is
+    due for a recheck, the next call event re-enables all disabled events.
+
+    Unless `all_threads` is true, only calls made on the thread that called
+    `start` are traced, matching the behavior of the sys.setprofile-based
+    CallTracer. Code rejected by the filter is disabled whichever thread
+    calls it first. Requires Python 3.12+.
+
+    Re-enabling disabled events (in `start`, and when rechecking converged
+    code) uses `restart_events`, which also re-enables the events that other
+    tools, such as coverage, have disabled. Those tools get their events again
+    until they disable them anew.
+    """
+
+    TOOL_NAME = 'monkeytype'
+
+    def __init__(
+        self,
+        logger: CallTraceLogger,
+        max_typed_dict_size: int,
+        code_filter: Optional[CodeFilter] = None,
+        sample_rate: Optional[int] = None,
+        signature_cache_size: Optional[int] = None,
+        all_threads: bool = False,
+        type_budget: Optional[TypeBudget] = None,
+        immutable_type_cache_size: Optional[int] = None,
+        deep_sample_rate: Optional[int] = None,
+        yield_sample_threshold: Optional[int] = None,
+        sampling_policy: Optional[SamplingPolicy] = None,
+        convergence: Optional[Convergence] = None,
+        cpu_budget: Optional[float] = None,
+        metrics_reporter: Optional[MetricsReporter] = None,
+        attribute_costs: bool = False,
+    ) -> None:
+        super().__init__(
+            logger, max_typed_dict_size, code_filter, sample_rate, signature_cache_size, all_threads, type_budget,
+            immutable_type_cache_size, deep_sample_rate, yield_sample_threshold, sampling_policy, convergence,
+            cpu_budget, metrics_reporter, attribute_costs)
+        self.tool_id: Optional[int] = None
+        self.thread_id: Optional[int] = None
+        # How far up the stack from a callback the frame of the event is.
+        self.frame_depth = 1
+        self.monitored_codes: Set[CodeType] = set()
+
+    @staticmethod
+    def find_tool_id() -> Optional[int]:
+        """Return a free sys.monitoring tool id, or None if none is available."""
+        if _monitoring is None:
+            return None
+        candidates = [_monitoring.PROFILER_ID] + [i for i in range(6) if i != _monitoring.PROFILER_ID]
+        for tool_id in candidates:
+            if _monitoring.get_tool(tool_id) is None:
+                return tool_id
+        return None
+
+    def _is_filtered(self, code: CodeType) -> bool:
+        return code.co_name == 'trace_types' or bool(self.should_trace and not self.should_trace(code))
+
+    def recheck(self) -> None:
+        """Trace converged code objects that are due for a recheck again."""
+        now = time.monotonic()
+        for code, until in list(self.converged.items()):
+            if until <= now:
+                self.is_converged(code)
+        self.next_recheck = min(self.converged.values(), default=float('inf'))
+        _monitoring.restart_events()
+
+    def _on_start(self, code: CodeType, instruction_offset: int) -> Any:
+        # The filter doesn't depend on the thread, so rejected code is
+        # disabled even when first called from a thread that isn't traced.
+        if self._is_filtered(code):
+            self.filtered += 1
+            return _monitoring.DISABLE
+        if self.thread_id is not None and threading.get_ident() != self.thread_id:
+            return None
+        self.events += 1
+        converged = self.converged
+        if converged:
+            if self.next_recheck <= time.monotonic():
+                self.recheck()
+            if code in converged and self.is_converged(code):
+                self.converged_calls += 1
+                return _monitoring.DISABLE
+        frame = sys._getframe(self.frame_depth)
+        try:
+            if self.costs is None:
+                self.handle_call(frame)
+            else:
+                with self.attributing(code):
+                    self.handle_call(frame)
+        except Exception:
+            logger.exception("Failed collecting trace")
+        if code in self.cache and self.cache[code] is None:
+            return _monitoring.DISABLE
+        if code not in self.monitored_codes:
+            # Returns and yields are only monitored for code objects that pass
+            # the filter, so rejected code never produces those events.
+            events = _monitoring.events
+            _monitoring.set_local_events(self.tool_id, code, events.PY_RETURN | events.PY_YIELD)
+            self.monitored_codes.add(code)
+        return None
+
+    def _on_return(self, code: CodeType, instruction_offset: int, retval: Any) -> None:
+        if self.thread_id is not None and threading.get_ident() != self.thread_id:
+            return
+        self.events += 1
+        trace = self.pop_trace(sys._getframe(self.frame_depth))
+        if trace is None:
+            return
+        try:
+            if self.costs is None:
+                self.handle_return_value(code, trace, retval)
+            else:
+                with self.attributing(code):
+                    self.handle_return_value(code, trace, retval)
+        except Exception:
+            logger.exception("Failed collecting trace")
+
+    def handle_return_value(self, code: CodeType, trace: CallTrace, retval: Any) -> None:
+        trace.return_type = self.get_type(trace, retval)
+        self.log_trace(code, trace)
+
+    def _on_yield(self, code: CodeType, instruction_offset: int, retval: Any) -> None:
+        if self.thread_id is not None and threading.get_ident() != self.thread_id:
+            return
+        self.events += 1
+        trace = self.get_trace(sys._getframe(self.frame_depth))
+        if trace is None:
+            return
+        try:
+            if self.costs is None:
+                self.handle_yield(code, trace, retval)
+            else:
+                with self.attributing(code):
+                    self.handle_yield(code, trace, retval)
+        except Exception:
+            logger.exception("Failed collecting trace")
+
+    def _on_unwind(self, code: CodeType, instruction_offset: int, exception: BaseException) -> None:
+        # PY_UNWIND can't be disabled, so keep this as cheap as possible for
+        # code we aren't tracing.
+        if self.thread_id is not None and threading.get_ident() != self.thread_id:
+            return
+        traces = self.traces
+        if not traces:
+            return
+        trace = self.pop_trace(sys._getframe(1))
+        if trace is not None:
+            try:
+                self.log_trace(code, trace)
+            except Exception:
+                logger.exception("Failed collecting trace")
+
+    def start(self) -> None:
+        tool_id = self.find_tool_id()
+        if tool_id is None:
+            raise RuntimeError("No free sys.monitoring tool id")
+        monitoring = _monitoring
+        events = monitoring.events
+        monitoring.use_tool_id(tool_id, self.TOOL_NAME)
+        self.tool_id = tool_id
+        self.thread_id = None if self.all_threads else threading.get_ident()
+        # The governor's timing wrapper adds a frame between the callbacks it
+        # wraps and the frame of the event.
+        self.frame_depth = 1 if self.governor is None else 2
+        monitoring.register_callback(tool_id, events.PY_START, self.timed(self._on_start))
+        monitoring.register_callback(tool_id, events.PY_RETURN, self.timed(self._on_return))
+        monitoring.register_callback(tool_id, events.PY_YIELD, self.timed(self._on_yield))
+        monitoring.register_callback(tool_id, events.PY_UNWIND, self._on_unwind)
+        # Code objects disabled by a previous tracer may pass this tracer's
+        # filter. This re-enables the events disabled by other tools too.
+        monitoring.restart_events()
+        # PY_UNWIND can only be enabled globally.
+        monitoring.set_events(tool_id, events.PY_START | events.PY_UNWIND)
+        if self.metrics_reporter is not None:
+            self.metrics_reporter.start(self)
+
+    def stop(self) -> None:
+        if self.tool_id is None:
+            return
+        monitoring = _monitoring
+        events = monitoring.events
+        monitoring.set_events(self.tool_id, events.NO_EVENTS)
+        for code in self.monitored_codes:
+            monitoring.set_local_events(self.tool_id, code, events.NO_EVENTS)
+        self.monitored_codes.clear()
+        for event in (events.PY_START, events.PY_RETURN, events.PY_YIELD, events.PY_UNWIND):
+            monitoring.register_callback(self.tool_id, event, None)
+        monitoring.free_tool_id(self.tool_id)
+        self.tool_id = None
+        if self.metrics_reporter is not None:
+            self.metrics_reporter.stop(self)
+
+
+def make_tracer(
+    logger: CallTraceLogger,
+    max_typed_dict_size: int,
+    code_filter: Optional[CodeFilter] = None,
+    sample_rate: Optional[int] = None,
+    signature_cache_size: Optional[int] = None,
+    all_threads: bool = False,
+    type_budget: Optional[TypeBudget] = None,
+    immutable_type_cache_size: Optional[int] = None,
+    deep_sample_rate: Optional[int] = None,
+    yield_sample_threshold: Optional[int] = None,
+    sampling_policy: Optional[SamplingPolicy] = None,
+    convergence: Optional[Convergence] = None,
+    cpu_budget: Optional[float] = None,
+    metrics_reporter: Optional[MetricsReporter] = None,
+    attribute_costs: bool = False,
+) -> CallTracer:
+    """Return the cheapest CallTracer available on this interpreter.
+
+    This is a MonitoringCallTracer when sys.monitoring is available and has a
+    free tool id, and a sys.setprofile-based CallTracer otherwise.
+    """
+    if MonitoringCallTracer.find_tool_id() is not None:
+        tracer_class: Type[CallTracer] = MonitoringCallTracer
+    else:
+        tracer_class = CallTracer
+    return tracer_class(
+        logger, max_typed_dict_size, code_filter, sample_rate, signature_cache_size, all_threads, type_budget,
+        immutable_type_cache_size, deep_sample_rate, yield_sample_threshold, sampling_policy, convergence,
+        cpu_budget, metrics_reporter, attribute_costs)
 
 
 @contextmanager
@@ -272,12 +1607,35 @@ def trace_calls(
     max_typed_dict_size: int,
     code_filter: Optional[CodeFilter] = None,
     sample_rate: Optional[int] = None,
-) -> Iterator[None]:
-    """Enable call tracing for a block of code"""
-    old_trace = sys.getprofile()
-    sys.setprofile(CallTracer(logger, max_typed_dict_size, code_filter, sample_rate))
-    try:
-        yield
-    finally:
-        sys.setprofile(old_trace)
-        logger.flush()
+    signature_cache_size: Optional[int] = None,
+    all_threads: bool = False,
+    type_budget: Optional[TypeBudget] = None,
+    immutable_type_cache_size: Optional[int] = None,
+    deep_sample_rate: Optional[int] = None,
+    yield_sample_threshold: Optional[int] = None,
+    sampling_policy: Optional[SamplingPolicy] = None,
+    convergence: Optional[Convergence] = None,
+    cpu_budget: Optional[float] = None,
+    metrics_reporter: Optional[MetricsReporter] = None,
+    attribute_costs: bool = False,
+    type_handlers: Optional[Mapping[type, TypeHandler]] = None,
+) -> Iterator[CallTracer]:
+    """Enable call tracing for a block of code, yielding the tracer.
+
+    With `all_threads`, calls on every thread are traced, and traces are
+    buffered per thread (see ThreadLocalCallTraceLogger) until the block exits.
+    `type_handlers` are registered in TYPE_HANDLERS until the block exits.
+    """
+    if all_threads:
+        logger = ThreadLocalCallTraceLogger(logger)
+    tracer = make_tracer(
+        logger, max_typed_dict_size, code_filter, sample_rate, signature_cache_size, all_threads, type_budget,
+        immutable_type_cache_size, deep_sample_rate, yield_sample_threshold, sampling_policy, convergence,
+        cpu_budget, metrics_reporter, attribute_costs)
+    with TYPE_HANDLERS.registered(type_handlers or {}):
+        tracer.start()
+        try:
+            yield tracer
+        finally:
+            tracer.stop()
+            logger.close()
@@ -4,15 +4,20 @@
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree.
 from collections import defaultdict
+from contextlib import contextmanager
+import enum
 import inspect
-from itertools import chain
+from itertools import chain, islice
 import types
+import weakref
 from abc import (
     ABC,
+    ABCMeta,
     abstractmethod,
 )
 from typing import (
     Any,
+    AsyncIterator,
     Callable,
     Dict,
     DefaultDict,
@@ -36,6 +41,7 @@ from monkeytype.compat import (
     name_of_generic,
     types_equal,
 )
+from monkeytype.util import BoundedCache
 
 from mypy_extensions import TypedDict
 
@@ -54,14 +60,29 @@ def is_list(typ: type) -> bool:
     return is_generic(typ) and name_of_generic(typ) == 'List'
 
 
+# Anonymous TypedDicts by their fields, so that each distinct shape is only
+# built once and equal shapes are usually the same object
+_typed_dicts: 'weakref.WeakValueDictionary[Any, type]' = weakref.WeakValueDictionary()
+
+
 def make_typed_dict(*, required_fields=None, optional_fields=None) -> type:
     required_fields = required_fields or {}
     optional_fields = optional_fields or {}
     assert required_fields.keys().isdisjoint(optional_fields.keys())
-    return TypedDict(DUMMY_TYPED_DICT_NAME, {
-        "required_fields": TypedDict(DUMMY_REQUIRED_TYPED_DICT_NAME, required_fields),
-        "optional_fields": TypedDict(DUMMY_OPTIONAL_TYPED_DICT_NAME, optional_fields)
-    })
+    try:
+        key = (frozenset(required_fields.items()), frozenset(optional_fields.items()))
+        typed_dict = _typed_dicts.get(key)
+    except TypeError:
+        # Unhashable field types can't be interned
+        key = typed_dict = None
+    if typed_dict is None:
+        typed_dict = TypedDict(DUMMY_TYPED_DICT_NAME, {
+            "required_fields": TypedDict(DUMMY_REQUIRED_TYPED_DICT_NAME, required_fields),
+            "optional_fields": TypedDict(DUMMY_OPTIONAL_TYPED_DICT_NAME, optional_fields)
+        })
+        if key is not None:
+            _typed_dicts[key] = typed_dict
+    return typed_dict
 
 
 def field_annotations(typed_dict) -> Tuple[Dict[str, type], Dict[str, type]]:
@@ -112,14 +133,49 @@ def shrink_typed_dict_types(typed_dicts: List[type], max_typed_dict_size: int) -
     return make_typed_dict(required_fields=required_fields, optional_fields=optional_fields)
 
 
+# Results of shrink_types, keyed by the distinct input types in the order
+# they're first seen and the max_typed_dict_size. The same sets of types are
+# shrunk over and over while tracing containers and when building stubs from
+# many traces.
+SHRINK_TYPES_CACHE = BoundedCache(maxsize=8192)
+_MISSING = object()
+
+
+def _ordered_key(typ):
+    """Return a cache key for typ that also tells apart the orders of its arguments.
+
+    Unions compare and hash equal whatever the order of their members, but
+    they render in that order."""
+    args = getattr(typ, '__args__', None)
+    if not isinstance(args, tuple) or not args:
+        return typ
+    return (typ, tuple(_ordered_key(arg) for arg in args))
+
+
 def shrink_types(types, max_typed_dict_size):
     """Return the smallest type equivalent to Union[types].
     If all the types are anonymous TypedDicts, shrink them ourselves.
     Otherwise, recursively turn the anonymous TypedDicts into Dicts.
-    Union will handle deduplicating types (both by equality and subtype relationships)."""
+    Union will handle deduplicating types (both by equality and subtype relationships).
+
+    Results are memoized in SHRINK_TYPES_CACHE by the distinct types in the
+    order they're first seen, which is the order Union renders them in."""
     types = tuple(types)
     if len(types) == 0:
         return Any
+    try:
+        key = (tuple(dict.fromkeys(types)), max_typed_dict_size)
+    except TypeError:
+        # Unhashable types can't be memoized
+        return _shrink_types(types, max_typed_dict_size)
+    shrunk = SHRINK_TYPES_CACHE.get(key, _MISSING)
+    if shrunk is _MISSING:
+        shrunk = _shrink_types(types, max_typed_dict_size)
+        SHRINK_TYPES_CACHE.put(key, shrunk)
+    return shrunk
+
+
+def _shrink_types(types, max_typed_dict_size):
     if all(is_anonymous_typed_dict(typ) for typ in types):
         return shrink_typed_dict_types(types, max_typed_dict_size)
     # Don't rewrite anonymous TypedDict to Dict if the types are all the same,
@@ -130,7 +186,11 @@ def shrink_types(types, max_typed_dict_size):
     # If they are all lists, shrink their argument types. This way, we avoid
     # rewriting heterogenous anonymous TypedDicts to Dict.
     if all(is_list(typ) for typ in types):
-        annotation = shrink_types((getattr(typ, '__args__')[0] for typ in types), max_typed_dict_size)
+        elem_types = [getattr(typ, '__args__')[0] for typ in types]
+        # An empty (or uninspected) list says nothing about the element type
+        # when other lists do.
+        inspected = [typ for typ in elem_types if not is_any(typ)]
+        annotation = shrink_types(inspected or elem_types, max_typed_dict_size)
         return List[annotation]
 
     all_dict_types = tuple(RewriteAnonymousTypedDictToDict().rewrite(typ) for typ in types)
@@ -145,6 +205,10 @@ def make_generator(yield_typ, send_typ, return_typ):
     return Generator[yield_typ, send_typ, return_typ]
 
 
+def make_async_iterator(typ):
+    return AsyncIterator[typ]
+
+
 _BUILTIN_CALLABLE_TYPES = (
     types.FunctionType,
     types.LambdaType,
@@ -154,49 +218,532 @@ _BUILTIN_CALLABLE_TYPES = (
 )
 
 
-def get_dict_type(dct, max_typed_dict_size):
-    """Return a TypedDict for `dct` if all the keys are strings.
-    Else, default to the union of the keys and of the values."""
+# A function returning the static type of a value, given the value and max_typed_dict_size
+TypeHandler = Callable[[Any, int], type]
+
+
+class TypeHandlers:
+    """A registry of functions that type values of particular types for get_type.
+
+    A handler is called with the value and max_typed_dict_size, and returns
+    the value's static type. A handler registered for a class applies to its
+    subclasses; one registered for an ABC also applies to the ABC's virtual
+    subclasses. The most specific class in a value's MRO wins, then ABCs in
+    registration order. Which handler applies is worked out once per concrete
+    type, so dispatching a value is a single dict lookup.
+
+    Handlers aren't consulted for exact lists, sets, tuples, dicts and
+    defaultdicts, which get_type always walks itself.
+    """
+
+    def __init__(self, handlers=None):
+        self.handlers = {}
+        self.dispatch = {}
+        for typ, handler in (handlers or {}).items():
+            self.register(typ, handler)
+
+    def register(self, typ, handler):
+        self.handlers[typ] = handler
+        self.dispatch.clear()
+
+    def unregister(self, typ):
+        del self.handlers[typ]
+        self.dispatch.clear()
+
+    @contextmanager
+    def registered(self, handlers):
+        """Register `handlers` for the duration of a block.
+
+        When the block exits, the handlers they replaced are restored, and the
+        others are unregistered."""
+        replaced = {typ: self.handlers.get(typ) for typ in handlers}
+        for typ, handler in handlers.items():
+            self.register(typ, handler)
+        try:
+            yield self
+        finally:
+            for typ, handler in replaced.items():
+                if handler is None:
+                    self.unregister(typ)
+                else:
+                    self.register(typ, handler)
+
+    def _resolve(self, typ):
+        for klass in typ.__mro__:
+            handler = self.handlers.get(klass)
+            if handler is not None:
+                return handler
+        for registered, handler in self.handlers.items():
+            if isinstance(registered, ABCMeta) and issubclass(typ, registered):
+                return handler
+        return None
+
+    def lookup(self, typ):
+        """Return the handler for values of exactly `typ`, or None."""
+        try:
+            return self.dispatch[typ]
+        except KeyError:
+            handler = self.dispatch[typ] = self._resolve(typ)
+            return handler
+        except TypeError:
+            # Unhashable metaclasses can't be cached
+            return self._resolve(typ)
+
+
+def _type_of_class(cls, max_typed_dict_size):
+    return Type[cls]
+
+
+def _callable(func, max_typed_dict_size):
+    return Callable
+
+
+def _iterator(generator, max_typed_dict_size):
+    return Iterator[Any]
+
+
+# The handlers get_type uses. Register handlers for third-party types here,
+# or return them from Config.type_handlers().
+TYPE_HANDLERS = TypeHandlers({
+    type: _type_of_class,
+    **{typ: _callable for typ in _BUILTIN_CALLABLE_TYPES},
+    types.GeneratorType: _iterator,
+})
+
+
+class TypeBudget:
+    """Bounds how much of a value get_type inspects.
+
+    A container with more than `max_elements` elements is typed from a
+    deterministic sample of them: for lists and tuples, the first and last
+    quarter of the budget (at least the first and last element, given a budget
+    of 2 or more) plus evenly strided elements in between; for other
+    containers, the first `max_elements` in iteration order. Containers nested
+    more than `max_depth` levels deep are typed with Any elements (and tuples
+    as Tuple[Any, ...]). `sampled` is set whenever either limit applied.
+
+    A budget carries state for a single value; use `fresh` to get an unused
+    budget with the same limits.
+    """
+
+    def __init__(self, max_elements=None, max_depth=None):
+        if max_elements is not None and max_elements < 1:
+            raise ValueError(f"max_elements must be at least 1, not {max_elements}")
+        if max_depth is not None and max_depth < 0:
+            raise ValueError(f"max_depth must be at least 0, not {max_depth}")
+        self.max_elements = max_elements
+        self.max_depth = max_depth
+        self.depth = 0
+        self.sampled = False
+
+    def fresh(self):
+        return TypeBudget(self.max_elements, self.max_depth)
+
+    def too_deep(self):
+        if self.max_depth is not None and self.depth >= self.max_depth:
+            self.sampled = True
+            return True
+        return False
+
+    def sample(self, elements):
+        limit = self.max_elements
+        if limit is None or len(elements) <= limit:
+            return elements
+        self.sampled = True
+        if not isinstance(elements, (list, tuple)):
+            return list(islice(elements, limit))
+        size = len(elements)
+        edge = limit // 4 or limit // 2
+        middle = limit - 2 * edge
+        # A budget of 2 has room for the edges only
+        indices = islice(range(edge, size - edge, max((size - 2 * edge) // middle, 1)), middle) if middle else ()
+        return [*elements[:edge], *(elements[i] for i in indices), *elements[size - edge:size]]
+
+
+# get_type builds types in an internal representation of interned nodes and
+# converts them to typing objects only when returning. Equal nodes are the same
+# object, so comparing, hashing and deduplicating them is cheap, and nothing
+# allocates typing generics or TypedDict classes for every element of a
+# container.
+
+_LEAF = 'leaf'
+_LIST = 'list'
+_SET = 'set'
+_DICT = 'dict'
+_DEFAULTDICT = 'defaultdict'
+_TUPLE = 'tuple'
+_VAR_TUPLE = 'var_tuple'
+_TYPED_DICT = 'typed_dict'
+_UNION = 'union'
+
+
+class _TypeNode:
+    """A node of the internal type representation.
+
+    `key` identifies the node among those of its `kind`: a type for leaves,
+    the child nodes for containers, and the members or fields of unions and
+    TypedDicts. `items` holds the latter in the order they're rendered in.
+    Unions and TypedDicts whose members or fields come in a different order
+    are different nodes, so that each renders the way the types it was built
+    from would.
+    """
+
+    __slots__ = ('kind', 'key', 'items')
+
+    def __init__(self, kind, key, items=()):
+        self.kind = kind
+        self.key = key
+        self.items = items
+
+    def __repr__(self):
+        return '_TypeNode(%r, %r)' % (self.kind, self.items or self.key)
+
+
+# Interned nodes by (kind, key), and the memoized conversions of nodes to
+# typing objects and of anonymous TypedDicts to Dicts. They are cleared
+# together between calls to get_type once there are too many nodes.
+_nodes = {}
+_node_types = {}
+_dict_nodes = {}
+_MAX_NODES = 1 << 16
+
+
+def _node(kind, key, items=()):
+    node = _nodes.get((kind, key))
+    if node is None:
+        node = _nodes.setdefault((kind, key), _TypeNode(kind, key, items))
+    return node
+
+
+def _leaf(typ):
+    try:
+        return _node(_LEAF, typ)
+    except TypeError:
+        # Unhashable types aren't interned
+        return _TypeNode(_LEAF, typ)
+
+
+_ANY = _node(_LEAF, Any)
+_STR = _node(_LEAF, str)
+
+
+def _union(nodes):
+    members = []
+    seen = set()
+    for node in nodes:
+        for member in (node.items if node.kind is _UNION else (node,)):
+            if member not in seen:
+                seen.add(member)
+                members.append(member)
+    if len(members) == 1:
+        return members[0]
+    members = tuple(members)
+    return _node(_UNION, members, members)
+
+
+def _typed_dict(required_fields, optional_fields=()):
+    required_fields = tuple(required_fields)
+    optional_fields = tuple(optional_fields)
+    return _node(_TYPED_DICT, (required_fields, optional_fields), (required_fields, optional_fields))
+
+
+def _convert(node):
+    kind = node.kind
+    if kind is _LEAF:
+        return node.key
+    elif kind is _LIST:
+        return List[_to_type(node.key)]
+    elif kind is _SET:
+        return Set[_to_type(node.key)]
+    elif kind is _DICT:
+        return Dict[_to_type(node.key[0]), _to_type(node.key[1])]
+    elif kind is _DEFAULTDICT:
+        return DefaultDict[_to_type(node.key[0]), _to_type(node.key[1])]
+    elif kind is _TUPLE:
+        return Tuple[tuple(_to_type(e) for e in node.key)] if node.key else Tuple[()]
+    elif kind is _VAR_TUPLE:
+        return Tuple[_to_type(node.key), ...]
+    elif kind is _TYPED_DICT:
+        required_fields, optional_fields = node.items
+        return make_typed_dict(required_fields={k: _to_type(v) for k, v in required_fields},
+                               optional_fields={k: _to_type(v) for k, v in optional_fields})
+    return Union[tuple(_to_type(m) for m in node.items)]
+
+
+def _to_type(node):
+    try:
+        return _node_types[node]
+    except KeyError:
+        typ = _node_types[node] = _convert(node)
+        return typ
+
+
+def _anonymous_typed_dicts_to_dicts(node):
+    """The equivalent of RewriteAnonymousTypedDictToDict for nodes."""
+    kind = node.kind
+    if kind is _LEAF or kind is _DEFAULTDICT:
+        return node
+    try:
+        return _dict_nodes[node]
+    except KeyError:
+        pass
+    rewrite = _anonymous_typed_dicts_to_dicts
+    if kind is _TYPED_DICT:
+        values = [v for _, v in chain(*node.items)]
+        if values:
+            rewritten = _node(_DICT, (_STR, _union(rewrite(v) for v in values)))
+        else:
+            # Special-case this because we can't justify any type.
+            rewritten = _node(_DICT, (_ANY, _ANY))
+    elif kind is _UNION:
+        rewritten = _union(rewrite(m) for m in node.items)
+    elif kind is _DICT or kind is _TUPLE:
+        rewritten = _node(kind, tuple(rewrite(e) for e in node.key))
+    else:
+        rewritten = _node(kind, rewrite(node.key))
+    _dict_nodes[node] = rewritten
+    return rewritten
+
+
+def _shrink_typed_dict_nodes(nodes, max_typed_dict_size):
+    """The equivalent of shrink_typed_dict_types for nodes."""
+    num_typed_dicts = len(nodes)
+    key_value_nodes = defaultdict(list)
+    existing_optional_fields = []
+    for node in nodes:
+        required_fields, optional_fields = node.items
+        for key, value in required_fields:
+            key_value_nodes[key].append(value)
+        existing_optional_fields.extend(optional_fields)
+
+    required = {key: values for key, values in key_value_nodes.items() if len(values) == num_typed_dicts}
+    optional = defaultdict(list)
+    for key, values in key_value_nodes.items():
+        if len(values) != num_typed_dicts:
+            optional[key] = values
+    for key, value in existing_optional_fields:
+        optional[key].append(value)
+
+    if len(required) + len(optional) > max_typed_dict_size:
+        values = list(chain.from_iterable(chain(required.values(), optional.values())))
+        return _node(_DICT, (_STR, _shrink_nodes(values, max_typed_dict_size)))
+    return _typed_dict(
+        ((key, _shrink_nodes(values, max_typed_dict_size)) for key, values in required.items()),
+        ((key, _shrink_nodes(values, max_typed_dict_size)) for key, values in optional.items()),
+    )
+
+
+def _shrink_nodes(nodes, max_typed_dict_size):
+    """The equivalent of shrink_types for nodes."""
+    if not nodes:
+        return _ANY
+    # Shrinking copies of one node, even a TypedDict, gives back that node
+    first = nodes[0]
+    if all(node is first for node in nodes):
+        return first
+    if all(node.kind is _TYPED_DICT for node in nodes):
+        return _shrink_typed_dict_nodes(nodes, max_typed_dict_size)
+    if all(node.kind is _LIST for node in nodes):
+        elem_nodes = [node.key for node in nodes]
+        # As in shrink_types, lists of Any say nothing when others are typed
+        inspected = [node for node in elem_nodes if node is not _ANY]
+        return _node(_LIST, _shrink_nodes(inspected or elem_nodes, max_typed_dict_size))
+    return _union(_anonymous_typed_dicts_to_dicts(node) for node in nodes)
+
+
+def _get_dict_node(dct, max_typed_dict_size, budget):
     if len(dct) == 0:
         # Special-case this because returning an empty TypedDict is
         # unintuitive, especially when you've "disabled" TypedDict generation
         # by setting `max_typed_dict_size` to 0.
-        return Dict[Any, Any]
-    if (all(isinstance(k, str) for k in dct.keys())
-            and (max_typed_dict_size is None or len(dct) <= max_typed_dict_size)):
-        return make_typed_dict(required_fields={k: get_type(v, max_typed_dict_size) for k, v in dct.items()})
+        return _node(_DICT, (_ANY, _ANY))
+    if ((max_typed_dict_size is None or len(dct) <= max_typed_dict_size)
+            and all(isinstance(k, str) for k in dct.keys())):
+        return _typed_dict((k, _get_node(v, max_typed_dict_size, budget)) for k, v in dct.items())
+    return _node(_DICT, _get_items_nodes(dct, max_typed_dict_size, budget))
+
+
+def _get_items_nodes(dct, max_typed_dict_size, budget):
+    """Return the key and value nodes of `dct`."""
+    if budget:
+        items = budget.sample(dct.items())
+        keys = [k for k, _ in items]
+        values = [v for _, v in items]
     else:
-        key_type = shrink_types((get_type(k, max_typed_dict_size) for k in dct.keys()), max_typed_dict_size)
-        val_type = shrink_types((get_type(v, max_typed_dict_size) for v in dct.values()), max_typed_dict_size)
-        return Dict[key_type, val_type]
-
-
-def get_type(obj, max_typed_dict_size):
-    """Return the static type that would be used in a type hint"""
-    if isinstance(obj, type):
-        return Type[obj]
-    elif isinstance(obj, _BUILTIN_CALLABLE_TYPES):
-        return Callable
-    elif isinstance(obj, types.GeneratorType):
-        return Iterator[Any]
-    typ = type(obj)
+        keys = dct.keys()
+        values = dct.values()
+    return (_get_elements_node(keys, max_typed_dict_size, budget),
+            _get_elements_node(values, max_typed_dict_size, budget))
+
+
+# Types whose values get_type types as the type itself, and that are common
+# enough as container elements to be worth checking for first
+_SCALAR_TYPES = frozenset({int, float, complex, bool, str, bytes, type(None)})
+
+
+def _get_elements_node(elems, max_typed_dict_size, budget):
+    # Homogeneous containers of scalars don't need their elements typed one by one
+    elem_types = set(map(type, elems))
+    if len(elem_types) == 1:
+        elem_type, = elem_types
+        node = _SCALAR_NODES.get(elem_type)
+        if node is not None:
+            return node
+    return _shrink_nodes([_get_node(e, max_typed_dict_size, budget) for e in elems], max_typed_dict_size)
+
+
+def _get_container_node(obj, typ, max_typed_dict_size, budget):
+    if typ is dict:
+        return _get_dict_node(obj, max_typed_dict_size, budget)
+    elif typ is defaultdict:
+        return _node(_DEFAULTDICT, _get_items_nodes(obj, max_typed_dict_size, budget))
+    elems = budget.sample(obj) if budget else obj
     if typ is list:
-        elem_type = shrink_types((get_type(e, max_typed_dict_size) for e in obj), max_typed_dict_size)
-        return List[elem_type]
+        return _node(_LIST, _get_elements_node(elems, max_typed_dict_size, budget))
     elif typ is set:
-        elem_type = shrink_types((get_type(e, max_typed_dict_size) for e in obj), max_typed_dict_size)
-        return Set[elem_type]
-    elif typ is dict:
-        return get_dict_type(obj, max_typed_dict_size)
-    elif typ is defaultdict:
-        key_type = shrink_types((get_type(k, max_typed_dict_size) for k in obj.keys()), max_typed_dict_size)
-        val_type = shrink_types((get_type(v, max_typed_dict_size) for v in obj.values()), max_typed_dict_size)
-        return DefaultDict[key_type, val_type]
-    elif typ is tuple:
-        return Tuple[tuple(get_type(e, max_typed_dict_size) for e in obj)]
+        return _node(_SET, _get_elements_node(elems, max_typed_dict_size, budget))
+    # A sampled tuple no longer has its original shape
+    if elems is not obj:
+        return _node(_VAR_TUPLE, _get_elements_node(elems, max_typed_dict_size, budget))
+    return _node(_TUPLE, tuple(_get_node(e, max_typed_dict_size, budget) for e in obj))
+
+
+# Nodes for containers too deeply nested for a TypeBudget to inspect
+_UNINSPECTED_CONTAINER_NODES = {
+    list: _node(_LIST, _ANY),
+    set: _node(_SET, _ANY),
+    dict: _node(_DICT, (_ANY, _ANY)),
+    defaultdict: _node(_DEFAULTDICT, (_ANY, _ANY)),
+    tuple: _node(_VAR_TUPLE, _ANY),
+}
+_SCALAR_NODES = {typ: _node(_LEAF, typ) for typ in _SCALAR_TYPES}
+
+
+def _get_node(obj, max_typed_dict_size, budget):
+    typ = type(obj)
+    if typ in _UNINSPECTED_CONTAINER_NODES:
+        return _get_checked_container_node(obj, typ, max_typed_dict_size, budget)
+    node = _SCALAR_NODES.get(typ)
+    if node is not None:
+        return node
+    handler = TYPE_HANDLERS.lookup(typ)
+    if handler is not None:
+        return _leaf(handler(obj, max_typed_dict_size))
+    return _leaf(typ)
+
+
+def _get_checked_container_node(obj, typ, max_typed_dict_size, budget):
+    if budget is None:
+        return _get_container_node(obj, typ, max_typed_dict_size, None)
+    if budget.too_deep():
+        return _UNINSPECTED_CONTAINER_NODES[typ]
+    budget.depth += 1
+    try:
+        return _get_container_node(obj, typ, max_typed_dict_size, budget)
+    finally:
+        budget.depth -= 1
+
+
+def _reset_nodes():
+    if len(_nodes) > _MAX_NODES:
+        _node_types.clear()
+        _dict_nodes.clear()
+        _nodes.clear()
+        for node in chain((_ANY, _STR), _UNINSPECTED_CONTAINER_NODES.values(),
+                          _SCALAR_NODES.values()):
+            _nodes[(node.kind, node.key)] = node
+
+
+def get_dict_type(dct, max_typed_dict_size, budget=None):
+    """Return a TypedDict for `dct` if all the keys are strings.
+    Else, default to the union of the keys and of the values."""
+    _reset_nodes()
+    return _to_type(_get_dict_node(dct, max_typed_dict_size, budget))
+
+
+def get_type(obj, max_typed_dict_size, budget=None):
+    """Return the static type that would be used in a type hint.
+
+    If a TypeBudget is given, only as much of `obj` as it allows is inspected.
+    """
+    _reset_nodes()
+    return _to_type(_get_node(obj, max_typed_dict_size, budget))
+
+
+def get_elements_type(elements, max_typed_dict_size, budget=None):
+    """Return the union of the types of `elements`, such as the values of a *args parameter.
+
+    If a TypeBudget is given, too many elements are typed from a sample.
+    """
+    _reset_nodes()
+    elements = budget.sample(elements) if budget else elements
+    return _to_type(_get_elements_node(elements, max_typed_dict_size, budget))
+
+
+# The shallow types of builtin containers and scalars
+_SHALLOW_TYPES = {
+    typ: _to_type(node) for typ, node in chain(_UNINSPECTED_CONTAINER_NODES.items(), _SCALAR_NODES.items())
+}
+
+
+def get_shallow_type(obj, max_typed_dict_size):
+    """Return the static type of `obj` without looking inside it.
+
+    Builtin containers are typed as C[Any], like the empty containers that
+    RemoveEmptyContainers drops from unions, so shallow types combine with the
+    full types of get_type when traces are shrunk and rewritten.
+    """
+    typ = type(obj)
+    shallow = _SHALLOW_TYPES.get(typ)
+    if shallow is not None:
+        return shallow
+    handler = TYPE_HANDLERS.lookup(typ)
+    if handler is not None:
+        return handler(obj, max_typed_dict_size)
     return typ
 
 
+# Types whose values can't change, and so can't change type
+_IMMUTABLE_TYPES = frozenset({int, float, complex, bool, str, bytes, type(None), frozenset, range})
+
+
+def is_deeply_immutable(obj):
+    """Return whether neither `obj` nor anything it contains can change."""
+    typ = type(obj)
+    if typ in _IMMUTABLE_TYPES or isinstance(obj, enum.Enum):
+        return True
+    return typ is tuple and all(is_deeply_immutable(e) for e in obj)
+
+
+class ImmutableTypeCache:
+    """Remembers the types of deeply immutable tuples by identity.
+
+    Tuples are the only immutable values whose elements get_type inspects, so
+    typing the same tuple constant again and again can skip the walk. The
+    cache holds a reference to each tuple it remembers, so an entry's id can't
+    be reused by another object while the entry exists.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.entries = BoundedCache(maxsize)
+
+    def get_type(self, obj, max_typed_dict_size, budget=None):
+        if type(obj) is not tuple:
+            return get_type(obj, max_typed_dict_size, budget)
+        entry = self.entries.get(id(obj))
+        if entry is not None and entry[0] is obj:
+            if entry[2] and budget is not None:
+                budget.sampled = True
+            return entry[1]
+        typ = get_type(obj, max_typed_dict_size, budget)
+        if is_deeply_immutable(obj):
+            self.entries.put(id(obj), (obj, typ, budget is not None and budget.sampled))
+        return typ
+
+    def info(self):
+        return self.entries.info()
+
+
 NoneType = type(None)
 NotImplementedType = type(NotImplemented)
 mappingproxy = type(range.__dict__)
@@ -205,6 +752,11 @@ mappingproxy = type(range.__dict__)
 T = TypeVar("T")
 
 
+# The rewrite_* method (or None) of each rewriter class for each type name,
+# so that GenericTypeRewriter.rewrite dispatches with one dict lookup
+_rewrite_methods = {}
+
+
 class GenericTypeRewriter(Generic[T], ABC):
     @abstractmethod
     def make_builtin_tuple(self, elements): ...
@@ -287,10 +839,11 @@ class GenericTypeRewriter(Generic[T], ABC):
             typname = name_of_generic(typ)
         else:
             typname = getattr(typ, '__name__', None)
-        rewriter = getattr(
-            self, 'rewrite_' + typname, None) if typname else None
+        rewriter = _rewrite_methods.get((type(self), typname), _MISSING) if typname else None
+        if rewriter is _MISSING:
+            rewriter = _rewrite_methods[(type(self), typname)] = getattr(type(self), 'rewrite_' + typname, None)
         if rewriter:
-            return rewriter(typ)
+            return rewriter(self, typ)
         if isinstance(typ, TypeVar):
             return self.rewrite_type_variable(typ)
         return self.generic_rewrite(typ)
@@ -327,7 +880,8 @@ class TypeRewriter(GenericTypeRewriter[type]):
 class RemoveEmptyContainers(TypeRewriter):
     """Remove redundant, empty containers from union types.
 
-    Empty containers are typed as C[Any] by MonkeyType. They should be removed
+    Empty containers are typed as C[Any] by MonkeyType (and so are containers
+    it didn't look inside, with Tuple[Any, ...] for tuples). They should be removed
     if there is a single concrete, non-null type in the Union. For example,
 
         Union[Set[Any], Set[int]] -> Set[int]
@@ -338,7 +892,7 @@ class RemoveEmptyContainers(TypeRewriter):
 
     def _is_empty(self, typ):
         args = getattr(typ, '__args__', [])
-        return args and all(is_any(e) for e in args)
+        return args and all(is_any(e) or e is Ellipsis for e in args)
 
     def rewrite_Union(self, union):
         elems = tuple(
@@ -416,14 +970,37 @@ class RewriteAnonymousTypedDictToDict(TypeRewriter):
 
 
 class ChainedRewriter(TypeRewriter):
-    def __init__(self, rewriters: Iterable[TypeRewriter]) -> None:
-        self.rewriters = rewriters
+    """Apply each of `rewriters` in turn to the whole type.
+
+    The passes are not fused into one traversal: each rewriter sees the
+    complete output of the previous one, which is what lets later rewriters
+    act on unions that earlier ones have simplified. Instead, results are
+    memoized by input type, including the order of its arguments, in a
+    bounded cache, since the same types recur across many functions when
+    generating stubs.
+    """
 
-    def rewrite(self, typ):
+    def __init__(self, rewriters: Iterable[TypeRewriter], cache_size: int = 4096) -> None:
+        self.rewriters = tuple(rewriters)
+        self.cache = BoundedCache(maxsize=cache_size)
+
+    def _rewrite(self, typ):
         for rw in self.rewriters:
             typ = rw.rewrite(typ)
         return typ
 
+    def rewrite(self, typ):
+        try:
+            key = _ordered_key(typ)
+            rewritten = self.cache.get(key, _MISSING)
+        except TypeError:
+            # Unhashable types can't be memoized
+            return self._rewrite(typ)
+        if rewritten is _MISSING:
+            rewritten = self._rewrite(typ)
+            self.cache.put(key, rewritten)
+        return rewritten
+
 
 class NoOpRewriter(TypeRewriter):
     def rewrite(self, typ):
@@ -13,16 +13,22 @@ from abc import (
 )
 from typing import (
     Any,
+    Callable,
+    Collection,
+    ContextManager,
     Dict,
     Generic,
     Iterable,
     List,
+    Mapping,
     Optional,
     Set,
     Tuple,
     TypeVar,
 )
 
+from monkeytype.util import BoundedCache, CacheInfo
+
 NoneType: type = ...
 NotImplementedType: type = ...
 mappingproxy: type = ...
@@ -45,13 +51,75 @@ def is_typed_dict(typ: type) -> bool: ...
 def is_anonymous_typed_dict(typ: type) -> bool: ...
 
 
+SHRINK_TYPES_CACHE: BoundedCache = ...
+
+
 def shrink_types(types: Iterable[type], max_typed_dict_size: int) -> type: ...
 
 
-def get_dict_type(dct: Any, max_typed_dict_size: int) -> type: ...
+TypeHandler = Callable[[Any, int], type]
+
+
+class TypeHandlers:
+    handlers: Dict[type, TypeHandler]
+    dispatch: Dict[type, Optional[TypeHandler]]
+
+    def __init__(self, handlers: Optional[Mapping[type, TypeHandler]] = None) -> None: ...
+
+    def register(self, typ: type, handler: TypeHandler) -> None: ...
+
+    def unregister(self, typ: type) -> None: ...
+
+    def registered(self, handlers: Mapping[type, TypeHandler]) -> ContextManager['TypeHandlers']: ...
+
+    def lookup(self, typ: type) -> Optional[TypeHandler]: ...
+
+
+TYPE_HANDLERS: TypeHandlers = ...
+
+
+class TypeBudget:
+    max_elements: Optional[int]
+    max_depth: Optional[int]
+    depth: int
+    sampled: bool
+
+    def __init__(self, max_elements: Optional[int] = None, max_depth: Optional[int] = None) -> None: ...
+
+    def fresh(self) -> 'TypeBudget': ...
+
+    def too_deep(self) -> bool: ...
+
+    def sample(self, elements: Any) -> Any: ...
 
 
-def get_type(obj: Any, max_typed_dict_size: int) -> type: ...
+def get_dict_type(dct: Any, max_typed_dict_size: int, budget: Optional[TypeBudget] = None) -> type: ...
+
+
+def get_type(obj: Any, max_typed_dict_size: int, budget: Optional[TypeBudget] = None) -> type: ...
+
+
+def get_elements_type(
+    elements: Collection[Any],
+    max_typed_dict_size: int,
+    budget: Optional[TypeBudget] = None,
+) -> type: ...
+
+
+def get_shallow_type(obj: Any, max_typed_dict_size: int) -> type: ...
+
+
+def is_deeply_immutable(obj: Any) -> bool: ...
+
+
+class ImmutableTypeCache:
+    entries: BoundedCache
+
+    def __init__(self, maxsize: int = 1024) -> None: ...
+
+    def get_type(self, obj: Any, max_typed_dict_size: int, budget: Optional[TypeBudget] = None) -> type: ...
+
+    def info(self) -> CacheInfo: ...
 
 
 def get_type_str(t: type) -> str: ...
@@ -64,6 +132,9 @@ def make_generator(yield_typ: type, send_typ: type, return_typ: type) -> type:
     ...
 
 
+def make_async_iterator(typ: type) -> type: ...
+
+
 T = TypeVar("T")
 
 
@@ -147,6 +218,13 @@ class IGRewriter(TypeRewriter):
     ...
 
 
+class ChainedRewriter(TypeRewriter):
+    rewriters: Tuple[TypeRewriter, ...]
+    cache: BoundedCache
+
+    def __init__(self, rewriters: Iterable[TypeRewriter], cache_size: int = 4096) -> None: ...
+
+
 class NoOpRewriter(TypeRewriter):
     ...
 
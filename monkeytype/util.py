@@ -3,8 +3,10 @@
 #
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree.
+from collections import OrderedDict
 import importlib
 import inspect
+import threading
 import types
 import re
 
@@ -16,6 +18,8 @@ except ImportError:
 from typing import (
     Any,
     Callable,
+    Hashable,
+    NamedTuple,
 )
 
 from monkeytype.exceptions import (
@@ -89,3 +93,47 @@ def get_name_in_module(
 
 def pascal_case(s: str) -> str:
     return ''.join(a[0].upper() + a[1:] for a in re.split('([^a-zA-Z0-9])', s) if a.isalnum())
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+class BoundedCache:
+    """A thread-safe mapping that keeps at most `maxsize` of its most recently
+    used entries and counts lookup hits and misses."""
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.entries: 'OrderedDict[Hashable, Any]' = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self.lock:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self.lock:
+            self.entries[key] = value
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self.entries))
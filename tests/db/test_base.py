@@ -3,15 +3,23 @@
 #
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree.
+import atexit
 import pytest
 import sqlite3
+import threading
 
-from monkeytype.db.base import CallTraceStoreLogger
+from monkeytype.db.base import (
+    BackgroundCallTraceStoreLogger,
+    CallTraceStoreLogger,
+    OverflowPolicy,
+    _close_loggers_at_exit,
+    _loggers_to_close_at_exit,
+)
 from monkeytype.db.sqlite import (
     create_call_trace_table,
     SQLiteStore,
 )
-from monkeytype.tracing import trace_calls
+from monkeytype.tracing import CallTrace, trace_calls
 from unittest.mock import patch
 
 
@@ -40,3 +48,218 @@ def test_round_trip(logger):
 
     assert not logger.store.filter('__main__')
     assert logger.store.filter(normal_func.__module__)
+
+
+def test_counts_reach_store(logger):
+    with trace_calls(logger, max_typed_dict_size=0, signature_cache_size=8):
+        for _ in range(5):
+            normal_func(1, 2)
+        assert len(logger.traces) == 1
+        logger.flush()
+        normal_func(1, 2)
+
+    thunks = logger.store.filter(normal_func.__module__)
+    assert len(thunks) == 1
+    assert thunks[0].to_trace().count == 6
+
+
+def test_calls_counted_while_storing_are_kept(logger):
+    trace = make_trace(int)
+    trace.count = 3
+    add = logger.store.add
+
+    def add_while_counting(traces):
+        # As if another thread counted a call while the traces were stored
+        trace.count += 1
+        add(traces)
+
+    logger.log(trace)
+    with patch.object(logger.store, 'add', side_effect=add_while_counting):
+        logger.flush()
+    assert list(logger.traces) == [trace]
+    assert trace.count == 1
+    logger.flush()
+    assert sum(thunk.to_trace().count for thunk in logger.store.filter(normal_func.__module__)) == 4
+
+
+class FailingStore(SQLiteStore):
+    def __init__(self) -> None:
+        conn = sqlite3.connect(':memory:')
+        create_call_trace_table(conn)
+        super().__init__(conn)
+        self.failing = True
+
+    def add(self, traces):
+        if self.failing:
+            raise sqlite3.OperationalError('database is locked')
+        super().add(traces)
+
+
+def make_trace(a) -> CallTrace:
+    return CallTrace(normal_func, {'a': a, 'b': int})
+
+
+class TestAutoFlush:
+    def test_flushes_at_max_traces(self, logger):
+        logger.max_traces = 2
+        logger.log(make_trace(int))
+        assert len(logger.traces) == 1
+        logger.log(make_trace(str))
+        assert not logger.traces
+        assert len(logger.store.filter(normal_func.__module__)) == 2
+
+    def test_flushes_at_max_bytes(self, logger):
+        logger.max_bytes = 1
+        logger.log(make_trace(int))
+        assert not logger.traces
+
+    def test_flushes_at_max_age(self, logger):
+        logger.max_age = 10
+        with patch('monkeytype.db.base.time.monotonic', return_value=100.0):
+            logger.log(make_trace(int))
+        with patch('monkeytype.db.base.time.monotonic', return_value=105.0):
+            logger.log(make_trace(str))
+        assert len(logger.traces) == 2
+        with patch('monkeytype.db.base.time.monotonic', return_value=110.0):
+            logger.log(make_trace(bytes))
+        assert not logger.traces
+
+    def test_keeps_traces_when_store_fails(self):
+        store = FailingStore()
+        logger = CallTraceStoreLogger(store, max_traces=1, flush_at_exit=False)
+        logger.log(make_trace(int))
+        assert logger.failed_flushes == 1
+        assert len(logger.traces) == 1
+        store.failing = False
+        logger.flush()
+        assert len(store.filter(normal_func.__module__)) == 1
+
+    def test_metrics(self, logger):
+        logger.max_traces = 2
+        logger.log(make_trace(int))
+        logger.log(make_trace(str))
+        logger.log(make_trace(bytes))
+        metrics = logger.metrics()
+        assert (metrics['logged'], metrics['buffered'], metrics['flushes'], metrics['rows_written']) == (3, 1, 1, 2)
+        assert metrics['last_flush_seconds'] >= 0
+
+    @pytest.mark.parametrize(
+        'policy, expected',
+        [
+            (OverflowPolicy.DROP_OLDEST, [str, bytes]),
+            (OverflowPolicy.DROP_NEWEST, [int, str]),
+        ],
+    )
+    def test_overflow_policy(self, policy, expected):
+        logger = CallTraceStoreLogger(FailingStore(), max_buffered=2, overflow_policy=policy, flush_at_exit=False)
+        for typ in (int, str, bytes):
+            logger.log(make_trace(typ))
+        assert [t.arg_types['a'] for t in logger.traces] == expected
+        assert logger.dropped_traces == 1
+
+    def test_flush_at_exit(self, logger):
+        logger.log(make_trace(int))
+        _close_loggers_at_exit()
+        assert not logger.traces
+        assert logger.store.filter(normal_func.__module__)
+
+    def test_loggers_share_one_exit_hook(self, logger):
+        callbacks = atexit._ncallbacks()
+        loggers = [CallTraceStoreLogger(logger.store) for _ in range(10)]
+        assert atexit._ncallbacks() == callbacks
+        assert all(other in _loggers_to_close_at_exit for other in loggers)
+        assert CallTraceStoreLogger(logger.store, flush_at_exit=False) not in _loggers_to_close_at_exit
+
+
+class BlockingStore(SQLiteStore):
+    """A store whose writes wait until released."""
+    def __init__(self) -> None:
+        conn = sqlite3.connect(':memory:', check_same_thread=False)
+        create_call_trace_table(conn)
+        super().__init__(conn)
+        self.release = threading.Event()
+        self.writing = threading.Event()
+
+    def add(self, traces):
+        self.writing.set()
+        self.release.wait()
+        super().add(traces)
+
+
+class TestBackgroundCallTraceStoreLogger:
+    def test_stores_from_writer_thread(self):
+        store = BlockingStore()
+        store.release.set()
+        logger = BackgroundCallTraceStoreLogger(store, batch_size=2)
+        with patch.object(store, 'add', wraps=store.add) as add:
+            logger.log(make_trace(int))
+            logger.log(make_trace(str))
+            logger.log(make_trace(bytes))
+            logger.close()
+        assert [len(call.args[0]) for call in add.call_args_list] == [2, 1]
+        assert len(store.filter(normal_func.__module__)) == 3
+        assert logger.writer is None
+
+    def test_writer_is_stopped_when_tracing_ends(self):
+        store = BlockingStore()
+        store.release.set()
+        logger = BackgroundCallTraceStoreLogger(store)
+        assert logger.writer is None
+        for arg in (1, 'a'):
+            with trace_calls(logger, max_typed_dict_size=0):
+                normal_func(arg, 2)
+            assert logger.writer is None
+        assert len(store.filter(normal_func.__module__)) == 2
+
+    def test_closed_at_exit(self):
+        store = BlockingStore()
+        store.release.set()
+        callbacks = atexit._ncallbacks()
+        logger = BackgroundCallTraceStoreLogger(store)
+        assert atexit._ncallbacks() == callbacks
+        logger.log(make_trace(int))
+        _close_loggers_at_exit()
+        assert logger.writer is None
+        assert store.filter(normal_func.__module__)
+
+    def test_counts_are_snapshotted(self):
+        store = BlockingStore()
+        store.release.set()
+        logger = BackgroundCallTraceStoreLogger(store, batch_size=1)
+        trace = make_trace(int)
+        trace.count = 3
+        logger.log(trace)
+        logger.close()
+        assert trace.count == 0
+        assert store.filter(normal_func.__module__)[0].to_trace().count == 3
+
+    def test_metrics(self):
+        store = BlockingStore()
+        store.release.set()
+        logger = BackgroundCallTraceStoreLogger(store, batch_size=2)
+        for typ in (int, str, bytes):
+            logger.log(make_trace(typ))
+        logger.close()
+        metrics = logger.metrics()
+        assert (metrics['logged'], metrics['rows_written'], metrics['dropped']) == (3, 3, 0)
+
+    @pytest.mark.parametrize(
+        'policy, expected',
+        [
+            (OverflowPolicy.DROP_OLDEST, [bytes]),
+            (OverflowPolicy.DROP_NEWEST, [str]),
+        ],
+    )
+    def test_overflow_policy(self, policy, expected):
+        store = BlockingStore()
+        logger = BackgroundCallTraceStoreLogger(store, batch_size=1, max_queue_size=1, overflow_policy=policy)
+        logger.log(make_trace(int))
+        # The writer is now stuck storing the first batch, with an empty queue
+        store.writing.wait()
+        logger.log(make_trace(str))
+        logger.log(make_trace(bytes))
+        assert logger.dropped_traces == 1
+        store.release.set()
+        logger.close()
+        stored = [thunk.to_trace().arg_types['a'] for thunk in store.filter(normal_func.__module__)]
+        assert sorted(stored, key=lambda t: t.__name__) == sorted([int] + expected, key=lambda t: t.__name__)
@@ -67,3 +67,29 @@ def test_limit_resultset(store):
     store.add(traces)
     thunks = store.filter(func.__module__, limit=1)
     assert len(thunks) == 1
+
+
+def test_call_counts_are_summed(store):
+    """Calls counted by the signature cache are summed across rows"""
+    store.add([CallTrace(func, {'a': int, 'b': str}, None, count=3)])
+    store.add([CallTrace(func, {'a': int, 'b': str}, None, count=2)])
+    thunks = store.filter(func.__module__)
+    assert len(thunks) == 1
+    assert thunks[0].to_trace().count == 5
+
+
+def test_adds_call_count_to_existing_table():
+    conn = sqlite3.connect(':memory:')
+    conn.execute("""
+    CREATE TABLE monkeytype_call_traces (
+      created_at  TEXT,
+      module      TEXT,
+      qualname    TEXT,
+      arg_types   TEXT,
+      return_type TEXT,
+      yield_type  TEXT);
+    """)
+    create_call_trace_table(conn)
+    store = SQLiteStore(conn)
+    store.add([CallTrace(func, {'a': int, 'b': str}, None)])
+    assert store.filter(func.__module__)[0].to_trace().count == 1
@@ -313,6 +313,17 @@ def test_toplevel_filename_parameter(store, db_file, stdout, stderr):
         assert ret == 0
 
 
+def test_run_tracing_costs(store, db_file, stdout, stderr, tmp_path):
+    script = tmp_path / 'script.py'
+    script.write_text(f'from {__name__} import func\nfunc(1, 2)\n')
+    with mock.patch.dict(os.environ, {DefaultConfig.DB_PATH_VAR: db_file.name}):
+        ret = cli.main(['run', '--tracing-costs', '5', str(script)], stdout, stderr)
+    assert ret == 0
+    lines = stderr.getvalue().splitlines()
+    assert lines[0].split() == ['total', 'ms', 'get_type', 'ms', 'calls', 'function']
+    assert any(line.split()[2:] == ['1', f'{__name__}.func'] for line in lines[1:])
+
+
 @pytest.mark.usefixtures("collector")
 def test_apply_stub_init(store, db_file, stdout, stderr, collector):
     """Regression test for applying stubs to testmodule/__init__.py style module layout"""
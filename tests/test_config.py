@@ -4,6 +4,7 @@
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree.
 import _frozen_importlib
+import pathlib
 import sysconfig
 
 import pytest
@@ -19,7 +20,7 @@ class TestDefaultCodeFilter:
         assert not config.default_code_filter(pytest.skip.__code__)
 
     def test_includes_otherwise(self):
-        assert config.default_code_filter(config.default_code_filter.__wrapped__.__code__)
+        assert config.default_code_filter(config.ModuleCodeFilter.decide.__code__)
 
     def test_excludes_frozen_importlib(self):
         assert not config.default_code_filter(_frozen_importlib.spec_from_loader.__code__)
@@ -27,4 +28,69 @@ class TestDefaultCodeFilter:
     def test_includes_stdlib_in_MONKEYTYPE_TRACE_MODULES(self, monkeypatch):
         monkeypatch.setenv('MONKEYTYPE_TRACE_MODULES', 'sysconfig')
         assert config.default_code_filter(sysconfig.get_config_vars.__code__)
+        assert not config.default_code_filter(config.ModuleCodeFilter.decide.__code__)
         monkeypatch.delenv('MONKEYTYPE_TRACE_MODULES')
+        assert not config.default_code_filter(sysconfig.get_config_vars.__code__)
+
+    def test_MONKEYTYPE_TRACE_MODULES_matches_path_components(self, tmp_path, monkeypatch):
+        monkeypatch.syspath_prepend(str(tmp_path / 'proj'))
+        monkeypatch.setenv('MONKEYTYPE_TRACE_MODULES', 'proj')
+        assert config.DefaultConfig().code_filter()(_code_in(str(tmp_path / 'proj' / 'pkg' / 'mod.py')))
+
+    def test_decision_is_cached_per_file(self):
+        code_filter = config.ModuleCodeFilter()
+        assert code_filter(config.ModuleCodeFilter.decide.__code__)
+        assert code_filter.decisions == {config.ModuleCodeFilter.decide.__code__.co_filename: True}
+
+
+def _code_in(filename):
+    return compile('pass', filename, 'exec')
+
+
+class TestModuleCodeFilter:
+    @pytest.fixture
+    def lib(self, tmp_path):
+        return tmp_path / 'lib'
+
+    @pytest.fixture
+    def app(self, tmp_path, monkeypatch):
+        monkeypatch.syspath_prepend(str(tmp_path / 'src'))
+        return tmp_path / 'src'
+
+    def test_excludes_lib_paths(self, lib, app):
+        code_filter = config.ModuleCodeFilter(lib_paths=[lib])
+        assert not code_filter(_code_in(str(lib / 'requests' / 'api.py')))
+        assert code_filter(_code_in(str(app / 'myapp' / 'views.py')))
+
+    @pytest.mark.parametrize(
+        'include, exclude, module, expected',
+        [
+            (['myapp'], [], 'myapp/views.py', True),
+            (['myapp'], [], 'other/views.py', False),
+            (['views'], [], 'myapp/views.py', True),
+            (['myapp.*'], [], 'myapp/views.py', True),
+            (['myapp.*'], [], 'other/myapp.py', False),
+            (None, ['myapp.migrations.*'], 'myapp/migrations/0001.py', False),
+            (None, ['myapp.migrations.*'], 'myapp/models.py', True),
+            (['myapp'], ['migrations'], 'myapp/migrations/0001.py', False),
+        ],
+    )
+    def test_include_exclude(self, lib, app, include, exclude, module, expected):
+        code_filter = config.ModuleCodeFilter(include, exclude, lib_paths=[lib])
+        assert code_filter(_code_in(str(app / module))) == expected
+
+    def test_include_lib_module(self, lib, app):
+        code_filter = config.ModuleCodeFilter(include=['requests.*'], lib_paths=[lib])
+        assert code_filter(_code_in(str(lib / 'requests' / 'api.py')))
+        assert not code_filter(_code_in(str(lib / 'urllib3' / 'requests.py')))
+
+    def test_excludes_code_without_source_file(self):
+        assert not config.ModuleCodeFilter()(_code_in('<string>'))
+
+
+class TestPathTrie:
+    def test_longest_prefix(self):
+        trie = config.PathTrie([pathlib.Path('/usr/lib'), pathlib.Path('/usr/lib/python3/site-packages')])
+        assert trie.longest_prefix(pathlib.Path('/usr/lib/python3/site-packages/foo.py')) == 5
+        assert trie.longest_prefix(pathlib.Path('/usr/lib/python3/os.py')) == 3
+        assert trie.longest_prefix(pathlib.Path('/usr/local/foo.py')) == -1
@@ -11,6 +11,7 @@ from inspect import (
 from textwrap import dedent
 from typing import (
     Any,
+    AsyncIterator,
     Callable,
     Dict,
     Generator,
@@ -1011,6 +1012,11 @@ class TestUpdateSignatureReturn:
         sig = update_signature_return(sig, return_type=NoneType, yield_type=str)
         assert sig == Signature(return_annotation=Iterator[str])
 
+    def test_update_async_generator_yield(self):
+        sig = Signature.from_callable(UpdateSignatureHelper.a_class_method)
+        sig = update_signature_return(sig, return_type=NoneType, yield_type=int, is_async_generator=True)
+        assert sig == Signature(return_annotation=AsyncIterator[int])
+
 
 def a_module_func() -> None:
     pass
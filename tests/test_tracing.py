@@ -3,23 +3,48 @@
 #
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree.
+import asyncio
+import functools
 import inspect
+import sys
+import threading
 from types import FrameType
 from typing import (
+    Any,
+    AsyncIterator,
     Iterator,
+    List,
     Optional,
+    Tuple,
+    Union,
 )
 
 import pytest
 from django.utils.functional import cached_property
 
 from monkeytype.tracing import (
+    MAX_VARIADIC_VALUES,
+    AdaptiveSamplingPolicy,
     CallTrace,
+    CallTracer,
     CallTraceLogger,
+    Convergence,
+    FastRandom,
+    MetricsReporter,
+    MonitoringCallTracer,
+    OverheadGovernor,
+    RateSamplingPolicy,
+    SamplingPolicy,
+    TracingCost,
+    ThreadLocalCallTraceLogger,
+    UNTRACED_THREADS,
     get_func,
+    get_func_in_module,
+    get_module_code_index,
+    make_tracer,
     trace_calls,
 )
-from monkeytype.typing import NoneType
+from monkeytype.typing import TYPE_HANDLERS, NoneType, TypeBudget
 
 
 class TraceCollector(CallTraceLogger):
@@ -73,6 +98,25 @@ def a_module_function() -> Optional[FrameType]:
     return inspect.currentframe()
 
 
+def a_decorator(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return func(*args, **kwargs)
+    return wrapper
+
+
+class GetFuncOuter:
+    class Inner:
+        @staticmethod
+        def a_nested_static_method() -> Optional[FrameType]:
+            return inspect.currentframe()
+
+    @staticmethod
+    @a_decorator
+    def a_decorated_static_method() -> Optional[FrameType]:
+        return inspect.currentframe()
+
+
 class TestGetFunc:
     @pytest.mark.parametrize(
         'frame, expected_func',
@@ -83,11 +127,60 @@ class TestGetFunc:
             (a_module_function(), a_module_function),
             (GetFuncHelper().a_property, GetFuncHelper.a_property.fget),
             (GetFuncHelper().a_cached_property, GetFuncHelper.a_cached_property.func),
+            (GetFuncOuter.Inner.a_nested_static_method(), GetFuncOuter.Inner.a_nested_static_method),
+            (GetFuncOuter.a_decorated_static_method(), GetFuncOuter.a_decorated_static_method.__wrapped__),
         ],
     )
     def test_get_func(self, frame, expected_func):
         assert get_func(frame) == expected_func
 
+    def test_module_code_index_is_rebuilt_when_globals_change(self):
+        namespace = {'GetFuncHelper': GetFuncHelper}
+        index = get_module_code_index(namespace)
+        assert index[GetFuncHelper.a_static_method.__code__] is GetFuncHelper.a_static_method
+        assert get_module_code_index(namespace) is index
+        namespace['GetFuncOuter'] = GetFuncOuter
+        index = get_module_code_index(namespace)
+        code = GetFuncOuter.Inner.a_nested_static_method.__code__
+        assert index[code] is GetFuncOuter.Inner.a_nested_static_method
+
+    def test_module_code_index_is_rebuilt_on_miss(self):
+        namespace = {'Helper': GetFuncHelper}
+        get_module_code_index(namespace)
+        namespace['Helper'] = GetFuncOuter.Inner
+        func = GetFuncOuter.Inner.a_nested_static_method
+        assert get_func_in_module(namespace, func.__code__) is func
+
+    def test_module_code_index_is_not_rebuilt_on_miss_of_unchanged_namespace(self):
+        namespace = {'GetFuncHelper': GetFuncHelper}
+        index = get_module_code_index(namespace)
+        code = (lambda: None).__code__
+        assert get_func_in_module(namespace, code) is None
+        assert get_func_in_module(namespace, code) is None
+        assert get_module_code_index(namespace) is index
+
+    def test_module_code_index_skips_raising_proxies(self):
+        namespace = {'request': RaisingProxy(), 'GetFuncHelper': GetFuncHelper}
+        func = GetFuncHelper.a_static_method
+        assert get_func_in_module(namespace, func.__code__) is func
+
+    def test_module_code_indexes_are_bounded(self, monkeypatch):
+        monkeypatch.setattr('monkeytype.tracing.MAX_MODULE_CODE_INDEXES', 2)
+        namespaces = [{'GetFuncHelper': GetFuncHelper} for _ in range(3)]
+        indexes = [get_module_code_index(namespace) for namespace in namespaces]
+        assert get_module_code_index(namespaces[2]) is indexes[2]
+        assert get_module_code_index(namespaces[0]) is not indexes[0]
+
+
+class RaisingProxy:
+    """Like a context-local proxy used outside of its context."""
+
+    def __getattribute__(self, name):
+        raise RuntimeError("Working outside of context")
+
+    def __call__(self):
+        pass
+
 
 def throw(should_recover: bool) -> None:
     try:
@@ -116,6 +209,15 @@ def squares(n: int) -> Iterator[int]:
         yield i * i
 
 
+def variadic(a: int, *args: Union[int, str], b: int = 1, **kwargs: float) -> int:
+    return a
+
+
+def ints_then_strs(n: int, switch: int) -> Iterator[Union[int, str]]:
+    for i in range(n):
+        yield i if i < switch else str(i)
+
+
 async def square(n: int) -> int:
     return n * n
 
@@ -127,6 +229,21 @@ async def sum_squares(n: int) -> int:
     return tot
 
 
+async def sleepy_square(n: int) -> int:
+    await asyncio.sleep(0)
+    return n * n
+
+
+async def async_squares(n: int) -> AsyncIterator[int]:
+    for i in range(n):
+        await asyncio.sleep(0)
+        yield i * i
+
+
+def delegating_squares(n: int) -> Iterator[int]:
+    yield from squares(n)
+
+
 def implicit_return_none() -> None:
     pass
 
@@ -241,6 +358,62 @@ class TestTraceCalls:
                 pass
         assert collector.traces == [CallTrace(squares, {'n': int}, NoneType, int)]
 
+    def test_generator_trace_with_profile_function(self, collector):
+        tracer = CallTracer(collector, max_typed_dict_size=0, code_filter=lambda code: code.co_name == 'squares')
+        traced(tracer, list, (squares(3),))
+        assert collector.traces == [CallTrace(squares, {'n': int}, NoneType, int)]
+
+    def test_variadic_and_keyword_only_args(self, collector):
+        with trace_calls(collector, max_typed_dict_size=0):
+            variadic(1, 2, 'a', b=3, c=1.0)
+            variadic(1)
+        assert collector.traces == [
+            CallTrace(variadic, {'a': int, 'args': Union[int, str], 'b': int, 'kwargs': float}, int),
+            CallTrace(variadic, {'a': int, 'b': int}, int),
+        ]
+        assert not collector.traces[0].sampled
+
+    def test_variadic_values_are_sampled(self, collector):
+        with trace_calls(collector, max_typed_dict_size=0):
+            variadic(1, *range(MAX_VARIADIC_VALUES), 'a')
+        assert collector.traces == [CallTrace(variadic, {'a': int, 'args': Union[int, str], 'b': int}, int)]
+        assert collector.traces[0].sampled
+
+    def test_yield_types_are_counted(self, collector):
+        with trace_calls(collector, max_typed_dict_size=0):
+            list(ints_then_strs(10, 8))
+        trace = collector.traces[0]
+        assert trace == CallTrace(ints_then_strs, {'n': int, 'switch': int}, NoneType, Union[int, str])
+        assert (trace.yield_types, trace.yields) == ({int: 8, str: 2}, 10)
+
+    def test_yields_are_sampled_after_threshold(self, collector):
+        with trace_calls(collector, max_typed_dict_size=0, yield_sample_threshold=2):
+            list(ints_then_strs(10, 8))
+        trace = collector.traces[0]
+        assert trace == CallTrace(ints_then_strs, {'n': int, 'switch': int}, NoneType, int)
+        assert (trace.yield_types, trace.yields, trace.sampled) == ({int: 4}, 10, True)
+
+    def test_delegating_generator_trace(self, collector):
+        code_filter = lambda code: code.co_name == 'delegating_squares'  # noqa: E731
+        with trace_calls(collector, max_typed_dict_size=0, code_filter=code_filter):
+            for _ in delegating_squares(3):
+                pass
+        assert collector.traces == [CallTrace(delegating_squares, {'n': int}, NoneType, int)]
+
+    def test_coroutine_trace(self, collector):
+        """Suspending at an await is neither a yield nor a return"""
+        with trace_calls(collector, max_typed_dict_size=0, code_filter=lambda code: code.co_name == 'sleepy_square'):
+            asyncio.run(sleepy_square(3))
+        assert collector.traces == [CallTrace(sleepy_square, {'n': int}, int)]
+
+    def test_async_generator_trace(self, collector):
+        async def consume():
+            return [i async for i in async_squares(3)]
+
+        with trace_calls(collector, max_typed_dict_size=0, code_filter=lambda code: code.co_name == 'async_squares'):
+            asyncio.run(consume())
+        assert collector.traces == [CallTrace(async_squares, {'n': int}, NoneType, int)]
+
     def test_return_none(self, collector):
         """Ensure traces have a return_type of NoneType for functions that return a value of None"""
         with trace_calls(collector, max_typed_dict_size=0):
@@ -288,3 +461,452 @@ class TestTraceCalls:
         lazy_val = LazyValue(explicit_return_none)
         with trace_calls(collector, max_typed_dict_size=0):
             lazy_val.value
+
+    def test_type_handlers_are_registered_for_the_block(self, collector):
+        class Meters(float):
+            pass
+
+        def meters_handler(value, max_typed_dict_size):
+            return float
+
+        with trace_calls(collector, max_typed_dict_size=0, code_filter=only_simple_add,
+                         type_handlers={Meters: meters_handler}):
+            simple_add(Meters(1), Meters(2))
+        assert collector.traces == [CallTrace(simple_add, {'a': float, 'b': float}, float)]
+        assert TYPE_HANDLERS.lookup(Meters) is None
+
+
+class TestTypeBudget:
+    def test_sampled_traces_are_marked(self, collector):
+        with trace_calls(collector, max_typed_dict_size=0, type_budget=TypeBudget(max_elements=2)):
+            simple_add([1], [2])
+            simple_add([1, 2, 3], [4])
+        assert collector.traces == [
+            CallTrace(simple_add, {'a': List[int], 'b': List[int]}, List[int]),
+            CallTrace(simple_add, {'a': List[int], 'b': List[int]}, List[int]),
+        ]
+        assert [t.sampled for t in collector.traces] == [False, True]
+
+
+class NeverSample(SamplingPolicy):
+    def sample(self, frame):
+        return False
+
+
+class TestSamplingPolicy:
+    def test_fast_random(self):
+        numbers = [FastRandom(seed=1).next() for _ in range(2)]
+        assert numbers[0] == numbers[1]
+        rng = FastRandom()
+        assert len({rng.next() % 4 for _ in range(100)}) == 4
+
+    def test_policies_are_seeded_randomly(self):
+        frame = sys._getframe()
+        policies = [RateSamplingPolicy(10), RateSamplingPolicy(10)]
+        runs = [[policy.sample(frame) for _ in range(200)] for policy in policies]
+        assert runs[0] != runs[1]
+        policies = [AdaptiveSamplingPolicy(warmup=0, seed=1), AdaptiveSamplingPolicy(warmup=0, seed=1)]
+        runs = [[policy.sample(frame) for _ in range(200)] for policy in policies]
+        assert runs[0] == runs[1]
+
+    def test_rate(self):
+        policy = RateSamplingPolicy(4)
+        frame = sys._getframe()
+        sampled = sum(policy.sample(frame) for _ in range(4000))
+        assert 800 < sampled < 1200
+
+    def test_adaptive_warmup_and_decay(self):
+        policy = AdaptiveSamplingPolicy(warmup=10, half_life=100, max_rate=4)
+        frame = sys._getframe()
+        assert all(policy.sample(frame) for _ in range(10))
+        assert 30 < sum(policy.sample(frame) for _ in range(99)) < 70
+        assert 150 < sum(policy.sample(frame) for _ in range(1000)) < 350
+
+    def test_adaptive_module_rates(self):
+        policy = AdaptiveSamplingPolicy(warmup=0, module_rates={'tests': 1, 'tests.test_tracing': 1000000})
+        assert policy.module_rate('tests.test_tracing.sub') == 1000000
+        assert policy.module_rate('tests.other') == 1
+        assert policy.module_rate('other') is None
+        assert not any(policy.sample(sys._getframe()) for _ in range(100))
+
+    def test_tracer_uses_policy(self, collector):
+        with trace_calls(collector, max_typed_dict_size=0, sampling_policy=AdaptiveSamplingPolicy(warmup=2)):
+            for i in range(2):
+                simple_add(i, i)
+        with trace_calls(collector, max_typed_dict_size=0, sampling_policy=NeverSample()):
+            simple_add(1, 2)
+        assert len(collector.traces) == 2
+
+
+def traced(tracer, func, *calls):
+    tracer.start()
+    try:
+        for args in calls:
+            func(*args)
+    finally:
+        tracer.stop()
+
+
+class TestConvergence:
+    def test_converges_after_calls(self, collector):
+        tracer = make_tracer(collector, max_typed_dict_size=0, convergence=Convergence(calls=2))
+        traced(tracer, simple_add, (1, 2), ('a', 'b'), (1, 2), ('a', 'b'), (3, 4), (5, 6))
+        assert len(collector.traces) == 4
+        assert simple_add.__code__ in tracer.converged
+
+    def test_converges_after_seconds(self, collector):
+        tracer = make_tracer(collector, max_typed_dict_size=0, convergence=Convergence(calls=None, seconds=0))
+        traced(tracer, simple_add, (1, 2), (1, 2), (1, 2))
+        assert len(collector.traces) == 2
+
+    def test_recheck(self, collector):
+        tracer = make_tracer(collector, max_typed_dict_size=0, convergence=Convergence(calls=1, recheck_interval=0))
+        traced(tracer, simple_add, (1, 2), (1, 2), (1, 2), (1, 2))
+        assert len(collector.traces) == 4
+
+
+class TestOverheadGovernor:
+    def test_throttles_and_recovers(self):
+        governor = OverheadGovernor(0.5, window=0, measure_every=1)
+        governor.record(10 ** 9)
+        assert (governor.level, governor.paused) == (1, False)
+        assert [governor.admit() for _ in range(4)] == [False, True, False, True]
+        while governor.history[-1].level:
+            governor.record(0)
+        assert governor.admit()
+        assert [window.level for window in governor.history] == [1, 0]
+
+    def test_pauses_at_max_level(self):
+        governor = OverheadGovernor(0.5, window=0, measure_every=1, max_level=0, pause=0)
+        governor.record(10 ** 9)
+        assert governor.paused
+        assert not governor.admit()
+        governor.record(0)
+        assert not governor.paused
+
+    def test_tracer_stays_within_budget(self, collector):
+        tracer = make_tracer(collector, max_typed_dict_size=0, code_filter=only_simple_add, cpu_budget=0.5)
+        tracer.governor = OverheadGovernor(0.0, window=0, measure_every=1, max_level=1, pause=0)
+        traced(tracer, simple_add, *[(1, 2)] * 100)
+        assert 0 < len(collector.traces) <= 50
+        assert tracer.governor.level > 0 or tracer.governor.paused
+
+    def test_tracer_within_budget_logs_every_call(self, collector):
+        tracer = make_tracer(collector, max_typed_dict_size=0, code_filter=only_simple_add, cpu_budget=1.0)
+        traced(tracer, simple_add, *[(1, 2)] * 100)
+        assert collector.traces == [CallTrace(simple_add, {'a': int, 'b': int}, int)] * 100
+
+
+class TestInFlightTraces:
+    def test_oldest_traces_are_evicted(self, collector):
+        tracer = CallTracer(collector, max_typed_dict_size=0, code_filter=lambda code: code.co_name == 'squares')
+        tracer.max_in_flight = 2
+        gens = [squares(2) for _ in range(3)]
+        tracer.start()
+        try:
+            for gen in gens:
+                next(gen)
+        finally:
+            tracer.stop()
+        assert len(tracer.traces) == 2
+        assert tracer.abandoned == 1
+
+    def test_trace_of_reused_frame_id_is_dropped(self, collector):
+        tracer = CallTracer(collector, max_typed_dict_size=0)
+        frame = sys._getframe()
+        tracer.traces[id(frame)] = (simple_add.__code__, CallTrace(simple_add, {}))
+        assert tracer.get_trace(frame) is None
+        assert (tracer.traces, tracer.abandoned) == ({}, 1)
+
+    def test_unsampled_call_drops_stale_trace(self, collector):
+        tracer = CallTracer(collector, max_typed_dict_size=0, sampling_policy=NeverSample())
+        frame = sys._getframe()
+        tracer.traces[id(frame)] = (frame.f_code, CallTrace(simple_add, {}))
+        tracer.handle_call(frame)
+        assert (tracer.traces, tracer.abandoned) == ({}, 1)
+
+
+class TestMetrics:
+    def test_counts_traced_calls(self, collector):
+        tracer = CallTracer(collector, max_typed_dict_size=0, code_filter=only_simple_add)
+        traced(tracer, simple_add, (1, 2), (3, 4), ('a', 'b'))
+        metrics = tracer.metrics()
+        assert metrics['traced'] == metrics['logged'] == 3
+        assert (metrics['func_cache_misses'], metrics['func_cache_hits']) == (1, 2)
+        assert (metrics['unsampled'], metrics['in_flight'], metrics['abandoned']) == (0, 0, 0)
+        assert metrics['filtered'] > 0
+        assert metrics['events'] > metrics['filtered']
+        assert metrics['logger'] == {}
+
+    def test_counts_unsampled_calls(self, collector):
+        tracer = CallTracer(
+            collector, max_typed_dict_size=0, code_filter=only_simple_add, sampling_policy=NeverSample())
+        traced(tracer, simple_add, (1, 2), (3, 4))
+        metrics = tracer.metrics()
+        assert (metrics['unsampled'], metrics['traced'], metrics['logged']) == (2, 0, 0)
+
+    def test_types_are_only_timed_when_reported(self, collector):
+        tracer = CallTracer(collector, max_typed_dict_size=0, code_filter=only_simple_add)
+        traced(tracer, simple_add, *[(1, 2)] * 32)
+        assert (tracer.get_type_calls, tracer.metrics()['get_type_ns']) == (0, {})
+        tracer = CallTracer(
+            collector, max_typed_dict_size=0, code_filter=only_simple_add,
+            metrics_reporter=MetricsReporter(lambda metrics: None))
+        traced(tracer, simple_add, *[(1, 2)] * 32)
+        assert tracer.get_type_calls == 96
+        assert sum(tracer.metrics()['get_type_ns'].values()) == 1
+
+    def test_reporter_reports_on_stop(self, collector):
+        reports = []
+        tracer = make_tracer(
+            collector, max_typed_dict_size=0, code_filter=only_simple_add,
+            metrics_reporter=MetricsReporter(reports.append))
+        traced(tracer, simple_add, (1, 2))
+        assert len(reports) == 1
+        assert reports[0]['traced'] == 1
+
+
+class TestTracingCosts:
+    def test_not_attributed_by_default(self, collector):
+        tracer = make_tracer(collector, max_typed_dict_size=0, code_filter=only_simple_add)
+        traced(tracer, simple_add, (1, 2))
+        assert tracer.costs is None
+        assert tracer.top_costs() == []
+
+    def test_attributes_costs_to_code(self, collector):
+        tracer = make_tracer(collector, max_typed_dict_size=0, code_filter=only_simple_add, attribute_costs=True)
+        traced(tracer, simple_add, (1, 2), (3, 4), ('a', 'b'))
+        [(code, cost)] = tracer.top_costs()
+        assert code is simple_add.__code__
+        assert (cost.calls, cost.events) == (3, 6)
+        assert cost.handler_ns >= cost.get_type_ns > 0
+
+    def test_top_costs_are_most_expensive_first(self, collector):
+        tracer = CallTracer(collector, max_typed_dict_size=0, attribute_costs=True)
+        cheap, expensive = TracingCost(), TracingCost()
+        cheap.handler_ns, expensive.handler_ns = 10, 20
+        tracer.costs = {simple_add.__code__: cheap, squares.__code__: expensive}
+        assert tracer.top_costs(1) == [(squares.__code__, expensive)]
+
+
+class TestDeepSampleRate:
+    def test_unsampled_calls_get_shallow_types(self, collector):
+        draws = FastRandom(seed=1)
+        shallow = [draws.next() % 2 != 0 for _ in range(8)]
+        assert True in shallow and False in shallow
+        with trace_calls(collector, max_typed_dict_size=0, code_filter=only_simple_add, deep_sample_rate=2) as tracer:
+            tracer.random = FastRandom(seed=1)
+            for _ in shallow:
+                simple_add([1], [2])
+        deep_trace = CallTrace(simple_add, {'a': List[int], 'b': List[int]}, List[int])
+        shallow_trace = CallTrace(simple_add, {'a': List[Any], 'b': List[Any]}, List[Any])
+        assert collector.traces == [shallow_trace if s else deep_trace for s in shallow]
+        assert [t.shallow for t in collector.traces] == shallow
+
+    def test_tracers_are_seeded_randomly(self, collector):
+        tracers = [CallTracer(collector, max_typed_dict_size=0, deep_sample_rate=2) for _ in range(2)]
+        assert tracers[0].random.state != tracers[1].random.state
+
+
+class TestImmutableTypeCache:
+    def test_repeated_constants_hit_the_cache(self, collector):
+        tracer = CallTracer(collector, max_typed_dict_size=0, immutable_type_cache_size=8)
+        constant = (1, 'a')
+        tracer.start()
+        try:
+            simple_add(constant, constant)
+            simple_add(constant, constant)
+        finally:
+            tracer.stop()
+        assert collector.traces == [CallTrace(simple_add, {'a': Tuple[int, str], 'b': Tuple[int, str]},
+                                              Tuple[int, str, int, str])] * 2
+        assert tracer.type_cache.info().hits == 3
+
+
+class TestSignatureCache:
+    def test_repeated_calls_are_counted(self, collector):
+        with trace_calls(collector, max_typed_dict_size=0, signature_cache_size=4):
+            for _ in range(3):
+                simple_add(1, 2)
+            simple_add('a', 'b')
+        assert collector.traces == [
+            CallTrace(simple_add, {'a': int, 'b': int}, int),
+            CallTrace(simple_add, {'a': str, 'b': str}, str),
+        ]
+        assert [t.count for t in collector.traces] == [3, 1]
+
+    def test_flushed_trace_is_logged_again(self, collector):
+        with trace_calls(collector, max_typed_dict_size=0, signature_cache_size=4):
+            simple_add(1, 2)
+            collector.traces[0].count = 0
+            simple_add(1, 2)
+        assert len(collector.traces) == 2
+        assert collector.traces[0] is collector.traces[1]
+        assert collector.traces[0].count == 1
+
+    def test_cache_is_bounded(self, collector):
+        with trace_calls(collector, max_typed_dict_size=0, signature_cache_size=1):
+            simple_add(1, 2)
+            simple_add('a', 'b')
+            simple_add(1, 2)
+        assert len(collector.traces) == 3
+
+
+def call_in_thread(func, *args):
+    thread = threading.Thread(target=func, args=args)
+    thread.start()
+    thread.join()
+
+
+def only_simple_add(code):
+    return code.co_name == 'simple_add'
+
+
+class TestAllThreads:
+    def test_traces_new_threads(self, collector):
+        with trace_calls(collector, max_typed_dict_size=0, code_filter=only_simple_add, all_threads=True):
+            call_in_thread(simple_add, 1, 2)
+            simple_add('a', 'b')
+        assert sorted(collector.traces, key=repr) == sorted([
+            CallTrace(simple_add, {'a': int, 'b': int}, int),
+            CallTrace(simple_add, {'a': str, 'b': str}, str),
+        ], key=repr)
+
+    def test_other_threads_not_traced_by_default(self, collector):
+        with trace_calls(collector, max_typed_dict_size=0, code_filter=only_simple_add):
+            call_in_thread(simple_add, 1, 2)
+        assert collector.traces == []
+
+    @pytest.mark.skipif(
+        not hasattr(threading, 'setprofile_all_threads'),
+        reason="requires threading.setprofile_all_threads or sys.monitoring",
+    )
+    def test_traces_running_threads(self, collector):
+        go = threading.Event()
+
+        def wait_then_add():
+            go.wait()
+            simple_add(1, 2)
+
+        thread = threading.Thread(target=wait_then_add)
+        thread.start()
+        with trace_calls(collector, max_typed_dict_size=0, code_filter=only_simple_add, all_threads=True):
+            go.set()
+            thread.join()
+        assert collector.traces == [CallTrace(simple_add, {'a': int, 'b': int}, int)]
+
+    def test_skips_untraced_threads(self, collector):
+        def untraced_add():
+            UNTRACED_THREADS.add(threading.get_ident())
+            try:
+                simple_add(1, 2)
+            finally:
+                UNTRACED_THREADS.discard(threading.get_ident())
+
+        with trace_calls(collector, max_typed_dict_size=0, code_filter=only_simple_add, all_threads=True):
+            call_in_thread(untraced_add)
+        assert collector.traces == []
+
+    def test_ignores_threads_started_while_installed_after_stop(self, collector):
+        go = threading.Event()
+
+        def wait_then_add():
+            go.wait()
+            simple_add(1, 2)
+
+        tracer = CallTracer(collector, max_typed_dict_size=0, code_filter=only_simple_add, all_threads=True)
+        tracer.start()
+        try:
+            thread = threading.Thread(target=wait_then_add)
+            thread.start()
+        finally:
+            tracer.stop()
+        events = tracer.events
+        go.set()
+        thread.join()
+        assert collector.traces == []
+        assert tracer.events == events
+
+
+class TestThreadLocalCallTraceLogger:
+    def test_merges_buffers_at_flush(self, collector):
+        logger = ThreadLocalCallTraceLogger(collector)
+        traces = [CallTrace(simple_add, {'a': int, 'b': int}, int), CallTrace(simple_add, {'a': str, 'b': str}, str)]
+        call_in_thread(logger.log, traces[0])
+        logger.log(traces[1])
+        assert collector.traces == []
+        logger.flush()
+        assert collector.traces == traces
+        assert collector.flushed
+        # The buffer of the exited thread is released
+        assert len(logger.buffers) == 1
+
+    def test_hands_off_full_batches(self, collector):
+        logger = ThreadLocalCallTraceLogger(collector, batch_size=2)
+        trace = CallTrace(simple_add, {'a': int, 'b': int}, int)
+        logger.log(trace)
+        assert collector.traces == []
+        logger.log(trace)
+        assert collector.traces == [trace, trace]
+        assert not collector.flushed
+
+
+@pytest.mark.skipif(MonitoringCallTracer.find_tool_id() is None, reason="requires sys.monitoring")
+class TestMonitoringCallTracer:
+    def test_trace_calls_uses_monitoring(self, collector):
+        assert isinstance(make_tracer(collector, max_typed_dict_size=0), MonitoringCallTracer)
+
+    def test_simple_call(self, collector):
+        tracer = MonitoringCallTracer(collector, max_typed_dict_size=0)
+        tracer.start()
+        try:
+            simple_add(1, 2)
+        finally:
+            tracer.stop()
+        assert collector.traces == [CallTrace(simple_add, {'a': int, 'b': int}, int)]
+
+    def test_filtered_code_is_disabled(self, collector):
+        """Rejected code objects should only reach the code filter once"""
+        seen = []
+
+        def code_filter(code):
+            seen.append(code)
+            return code.co_name == 'simple_add'
+
+        with trace_calls(collector, max_typed_dict_size=0, code_filter=code_filter):
+            for _ in range(3):
+                explicit_return_none()
+                simple_add(1, 2)
+        assert seen.count(explicit_return_none.__code__) == 1
+        assert len(collector.traces) == 3
+
+    def test_filtered_code_is_disabled_on_other_threads(self, collector):
+        seen = []
+
+        def code_filter(code):
+            seen.append(code)
+            return code.co_name == 'simple_add'
+
+        with trace_calls(collector, max_typed_dict_size=0, code_filter=code_filter):
+            for _ in range(3):
+                call_in_thread(explicit_return_none)
+        assert seen.count(explicit_return_none.__code__) == 1
+        assert collector.traces == []
+
+    def test_callee_throws(self, collector):
+        tracer = MonitoringCallTracer(collector, max_typed_dict_size=0)
+        tracer.start()
+        try:
+            throw(should_recover=False)
+        except Exception:
+            pass
+        finally:
+            tracer.stop()
+        assert collector.traces == [CallTrace(throw, {'should_recover': bool})]
+
+    def test_releases_tool_id(self, collector):
+        tracer = MonitoringCallTracer(collector, max_typed_dict_size=0)
+        tracer.start()
+        tool_id = tracer.tool_id
+        tracer.stop()
+        assert sys.monitoring.get_tool(tool_id) is None
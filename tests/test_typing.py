@@ -3,7 +3,9 @@
 #
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree.
+import collections.abc
 from collections import defaultdict
+import enum
 from typing import (
     Any,
     Callable,
@@ -23,19 +25,29 @@ from typing import (
 import pytest
 
 from monkeytype.typing import (
+    TYPE_HANDLERS,
+    TypeHandlers,
+    ChainedRewriter,
+    ImmutableTypeCache,
     NoneType,
     RemoveEmptyContainers,
     RewriteConfigDict,
     RewriteLargeUnion,
     RewriteAnonymousTypedDictToDict,
+    DEFAULT_REWRITER,
     field_annotations,
+    get_shallow_type,
     get_type,
+    is_deeply_immutable,
     is_list,
     is_typed_dict,
     make_typed_dict,
     shrink_types,
     types_equal,
+    NoOpRewriter,
     RewriteGenerator,
+    SHRINK_TYPES_CACHE,
+    TypeBudget,
     TypeRewriter,
     DUMMY_OPTIONAL_TYPED_DICT_NAME,
     DUMMY_REQUIRED_TYPED_DICT_NAME,
@@ -143,6 +155,12 @@ class TestMakeTypedDict:
                                      optional_fields=optional_fields)
         assert field_annotations(typed_dict) == (required_fields, optional_fields)
 
+    def test_same_shape_is_interned(self):
+        typed_dict = make_typed_dict(required_fields={'a': int, 'b': List[str]})
+        assert make_typed_dict(required_fields={'b': List[str], 'a': int}) is typed_dict
+        assert make_typed_dict(required_fields={'a': int}, optional_fields={'b': List[str]}) is not typed_dict
+        assert Union[typed_dict, make_typed_dict(required_fields={'a': int, 'b': List[str]})] is typed_dict
+
 
 class TestShrinkType:
     @pytest.mark.parametrize(
@@ -397,6 +415,8 @@ class TestShrinkType:
             ((int, NoneType), Optional[int]),
             ((int, str), Union[int, str]),
             ((int, str, NoneType), Optional[Union[int, str]]),
+            ((List[Any], List[int]), List[int]),
+            ((List[Any], List[Any]), List[Any]),
         ],
     )
     def test_shrink_types(self, types, expected_type):
@@ -434,6 +454,14 @@ class TestShrinkType:
     def test_shrink_types_mixed_dicts(self, types, expected_type):
         assert shrink_types(types, max_typed_dict_size=VERY_LARGE_MAX_TYPED_DICT_SIZE) == expected_type
 
+    def test_shrink_types_is_memoized(self):
+        SHRINK_TYPES_CACHE.clear()
+        assert shrink_types([int, str, int], max_typed_dict_size=0).__args__ == (int, str)
+        assert shrink_types([str, int, int], max_typed_dict_size=0).__args__ == (str, int)
+        assert shrink_types([int, str], max_typed_dict_size=0).__args__ == (int, str)
+        info = SHRINK_TYPES_CACHE.info()
+        assert (info.hits, info.misses) == (1, 2)
+
 
 class TestTypedDictHelpers:
     @pytest.mark.parametrize(
@@ -627,6 +655,214 @@ class TestGetType:
         """Return the correct type for classes"""
         assert get_type(Dummy, max_typed_dict_size=VERY_LARGE_MAX_TYPED_DICT_SIZE) == Type[Dummy]
 
+    @pytest.mark.parametrize(
+        'value, expected_type',
+        [
+            ([None, None], List[NoneType]),
+            ([1, True], List[Union[int, bool]]),
+            ([[1], [2]], List[List[int]]),
+            ({1.0, 2.0}, Set[float]),
+            ({1: 'a', 2: 'b'}, Dict[int, str]),
+            ({1: 'a', 2: ['b']}, Dict[int, Union[str, List[str]]]),
+            ([Dummy(), Dummy()], List[Dummy]),
+        ],
+    )
+    def test_homogeneous_containers(self, value, expected_type):
+        assert get_type(value, max_typed_dict_size=0) == expected_type
+
+    def test_equal_types_are_shared(self):
+        typ = get_type([{'a': 1, 'b': [1, 'x']}, {'a': 2}], max_typed_dict_size=VERY_LARGE_MAX_TYPED_DICT_SIZE)
+        assert typ == List[make_typed_dict(required_fields={'a': int},
+                                           optional_fields={'b': List[Union[int, str]]})]
+        assert get_type([{'a': 3}, {'b': [2, 'y'], 'a': 4}],
+                        max_typed_dict_size=VERY_LARGE_MAX_TYPED_DICT_SIZE).__args__[0] is typ.__args__[0]
+
+    def test_union_order_is_kept(self):
+        assert get_type([2.0, b'x'], max_typed_dict_size=0).__args__[0].__args__ == (float, bytes)
+        key_type, value_type = get_type({1.0: b'a', b'b': 2.0}, max_typed_dict_size=0).__args__
+        assert (key_type.__args__, value_type.__args__) == ((float, bytes), (bytes, float))
+
+    def test_uninspected_lists_are_ignored(self):
+        assert get_type([[], [1]], max_typed_dict_size=0) == List[List[int]]
+
+
+class TestTypeBudget:
+    def test_sample_sequence(self):
+        budget = TypeBudget(max_elements=8)
+        assert budget.sample(list(range(100))) == [0, 1, 2, 26, 50, 74, 98, 99]
+        assert budget.sampled
+
+    @pytest.mark.parametrize(
+        'max_elements, expected',
+        [
+            (1, [0]),
+            (2, [0, 99]),
+            (3, [0, 1, 99]),
+        ],
+    )
+    def test_small_budget_keeps_ends(self, max_elements, expected):
+        assert TypeBudget(max_elements=max_elements).sample(list(range(100))) == expected
+
+    @pytest.mark.parametrize('kwargs', [{'max_elements': 0}, {'max_depth': -1}])
+    def test_invalid_limits(self, kwargs):
+        with pytest.raises(ValueError):
+            TypeBudget(**kwargs)
+
+    def test_sample_unordered(self):
+        budget = TypeBudget(max_elements=3)
+        assert len(budget.sample(set(range(100)))) == 3
+        assert budget.sampled
+
+    def test_small_containers_are_not_sampled(self):
+        budget = TypeBudget(max_elements=3, max_depth=3)
+        assert get_type([1, 2, 3], 0, budget) == List[int]
+        assert not budget.sampled
+
+    @pytest.mark.parametrize(
+        'value, expected_type',
+        [
+            ([1] * 10 + ['a'], List[Union[int, str]]),
+            ([1, 1, 1, 'a'] + [1] * 7, List[int]),
+            ((1,) * 10, typing_Tuple[int, ...]),
+            ({i: str(i) for i in range(10)}, Dict[int, str]),
+            (get_default_dict(key=1, value=1.0), DefaultDict[int, float]),
+        ],
+    )
+    def test_element_budget(self, value, expected_type):
+        budget = TypeBudget(max_elements=4)
+        assert get_type(value, max_typed_dict_size=0, budget=budget) == expected_type
+
+    @pytest.mark.parametrize(
+        'value, expected_type',
+        [
+            ([[[1]]], List[List[List[Any]]]),
+            ([{'a': [1]}], List[Dict[str, List[Any]]]),
+            (([1], ((1,),)), typing_Tuple[List[int], typing_Tuple[typing_Tuple[Any, ...]]]),
+        ],
+    )
+    def test_depth_budget(self, value, expected_type):
+        budget = TypeBudget(max_depth=2)
+        assert get_type(value, max_typed_dict_size=0, budget=budget) == expected_type
+        assert budget.sampled
+        assert budget.depth == 0
+
+
+class TestGetShallowType:
+    @pytest.mark.parametrize(
+        'value, expected_type',
+        [
+            (1, int),
+            ([1], List[Any]),
+            ({'a': 1}, Dict[Any, Any]),
+            ((1, 'a'), typing_Tuple[Any, ...]),
+            (get_default_dict(key=1, value=1.0), DefaultDict[Any, Any]),
+            (Dummy(), Dummy),
+        ],
+    )
+    def test_get_shallow_type(self, value, expected_type):
+        assert get_shallow_type(value, max_typed_dict_size=0) == expected_type
+
+    def test_combines_with_full_types(self):
+        for value in ([1], {'a': 1}, (1, 'a')):
+            typ = shrink_types([get_shallow_type(value, 0), get_type(value, 0)], max_typed_dict_size=0)
+            assert DEFAULT_REWRITER.rewrite(typ) == DEFAULT_REWRITER.rewrite(get_type(value, 0))
+
+
+class Matrix:
+    def __init__(self, dtype):
+        self.dtype = dtype
+
+
+class SparseMatrix(Matrix):
+    pass
+
+
+class Sized:
+    def __len__(self):
+        return 0
+
+
+def matrix_handler(matrix, max_typed_dict_size):
+    return List[List[matrix.dtype]]
+
+
+def sized_handler(obj, max_typed_dict_size):
+    return collections.abc.Sized
+
+
+class TestTypeHandlers:
+    def test_dispatch(self):
+        handlers = TypeHandlers({Matrix: matrix_handler, collections.abc.Sized: sized_handler})
+        assert handlers.lookup(Matrix) is matrix_handler
+        assert handlers.lookup(SparseMatrix) is matrix_handler
+        assert handlers.lookup(Sized) is sized_handler
+        assert handlers.lookup(int) is None
+
+    def test_most_specific_class_wins(self):
+        handlers = TypeHandlers({Matrix: matrix_handler})
+        assert handlers.lookup(SparseMatrix) is matrix_handler
+        handlers.register(SparseMatrix, sized_handler)
+        assert handlers.lookup(SparseMatrix) is sized_handler
+        handlers.unregister(SparseMatrix)
+        assert handlers.lookup(SparseMatrix) is matrix_handler
+
+    def test_get_type_uses_registered_handlers(self):
+        TYPE_HANDLERS.register(Matrix, matrix_handler)
+        try:
+            assert get_type([SparseMatrix(float)], max_typed_dict_size=0) == List[List[List[float]]]
+        finally:
+            TYPE_HANDLERS.unregister(Matrix)
+        assert get_type([SparseMatrix(float)], max_typed_dict_size=0) == List[SparseMatrix]
+
+    def test_registered_for_a_block(self):
+        handlers = TypeHandlers({Matrix: matrix_handler})
+        with handlers.registered({Matrix: sized_handler, Sized: sized_handler}):
+            assert handlers.lookup(SparseMatrix) is sized_handler
+            assert handlers.lookup(Sized) is sized_handler
+        assert handlers.lookup(SparseMatrix) is matrix_handler
+        assert handlers.lookup(Sized) is None
+
+
+class Color(enum.Enum):
+    RED = 1
+
+
+class TestImmutableTypeCache:
+    @pytest.mark.parametrize(
+        'value, expected',
+        [
+            ((1, 'a', b'b', 1.0, None, Color.RED, frozenset({1}), ((2,),)), True),
+            ((1, [2]), False),
+            (({},), False),
+            (Dummy(), False),
+        ],
+    )
+    def test_is_deeply_immutable(self, value, expected):
+        assert is_deeply_immutable(value) == expected
+
+    def test_remembers_immutable_tuples(self):
+        cache = ImmutableTypeCache()
+        value = (1, ('a', None))
+        for _ in range(3):
+            assert cache.get_type(value, max_typed_dict_size=0) == typing_Tuple[int, typing_Tuple[str, NoneType]]
+        assert (cache.info().hits, cache.info().misses) == (2, 1)
+
+    def test_ignores_mutable_tuples(self):
+        cache = ImmutableTypeCache()
+        value = (1, [])
+        assert cache.get_type(value, max_typed_dict_size=0) == typing_Tuple[int, List[Any]]
+        value[1].append('a')
+        assert cache.get_type(value, max_typed_dict_size=0) == typing_Tuple[int, List[str]]
+        assert cache.info().currsize == 0
+
+    def test_remembers_sampling(self):
+        cache = ImmutableTypeCache()
+        value = (1, 2, 3)
+        cache.get_type(value, 0, TypeBudget(max_elements=2))
+        budget = TypeBudget(max_elements=2)
+        assert cache.get_type(value, 0, budget) == typing_Tuple[int, ...]
+        assert budget.sampled
+
 
 class Tuple:
     """A name conflict that is not generic."""
@@ -683,6 +919,7 @@ class TestRemoveEmptyContainers:
             (Union[List[Any], Set[Any]], Union[List[Any], Set[Any]]),
             (Tuple, Tuple),
             (typing_Tuple[()], typing_Tuple[()]),
+            (Union[typing_Tuple[Any, ...], typing_Tuple[int, str]], typing_Tuple[int, str]),
         ],
     )
     def test_rewrite(self, typ, expected):
@@ -808,6 +1045,25 @@ class TestRewriteGenerator:
         assert rewritten == expected
 
 
+class TestChainedRewriter:
+    def test_applies_rewriters_in_order(self):
+        rewriter = ChainedRewriter(rw for rw in (RemoveEmptyContainers(), RewriteLargeUnion(max_union_len=1)))
+        assert rewriter.rewrite(Union[List[Any], List[int]]) == List[int]
+        assert rewriter.rewrite(Union[int, str]) == Any
+
+    def test_results_are_memoized(self):
+        rewriter = ChainedRewriter((RewriteGenerator(),))
+        assert rewriter.rewrite(Generator[int, NoneType, NoneType]) == Iterator[int]
+        assert rewriter.rewrite(Generator[int, NoneType, NoneType]) == Iterator[int]
+        info = rewriter.cache.info()
+        assert (info.hits, info.misses) == (1, 1)
+
+    def test_union_order_is_kept(self):
+        rewriter = ChainedRewriter((NoOpRewriter(),))
+        assert rewriter.rewrite(Union[float, bytes]).__args__ == (float, bytes)
+        assert rewriter.rewrite(Union[bytes, float]).__args__ == (bytes, float)
+
+
 class TestRewriteAnonymousTypedDictToDict:
     @pytest.mark.parametrize(
         'typ, expected',
@@ -10,6 +10,8 @@ from monkeytype.exceptions import (
     NameLookupError,
 )
 from monkeytype.util import (
+    BoundedCache,
+    CacheInfo,
     get_func_in_module,
     get_name_in_module,
     pascal_case,
@@ -93,3 +95,20 @@ class TestPascalCase:
     )
     def test_pascal_case(self, input_string: str, expected: str):
         assert pascal_case(input_string) == expected
+
+
+class TestBoundedCache:
+    def test_counts_hits_and_misses(self):
+        cache = BoundedCache(maxsize=2)
+        assert cache.get('a') is None
+        cache.put('a', 1)
+        assert cache.get('a') == 1
+        assert cache.info() == CacheInfo(hits=1, misses=1, maxsize=2, currsize=1)
+
+    def test_evicts_least_recently_used(self):
+        cache = BoundedCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        assert list(cache.entries) == ['a', 'c']